@@ -108,6 +108,75 @@ class IMPORT_OT_egg(bpy.types.Operator, ImportHelper):
             default = True,
             description = "Automatically tries to bind actions to armatures."
         )
+        legacy_parser: props.BoolProperty(
+            name = "Legacy parser",
+            default = False,
+            description = "Uses the original character-by-character .egg parser "
+                          "instead of the faster buffer-based one."
+        )
+        memory_map: props.BoolProperty(
+            name = "Memory-map files",
+            default = True,
+            description = "Parses uncompressed .egg files directly from a memory-mapped view "
+                          "of the file, rather than reading them into memory first."
+        )
+        exclude_types: props.StringProperty(
+            name = "Exclude elements",
+            default = "",
+            description = "Comma-separated list of element types to leave out of the import, "
+                          "such as Table, Collide or NurbsCurve.  Collide excludes whole collision groups."
+        )
+        exclude_groups: props.StringProperty(
+            name = "Exclude groups",
+            default = "",
+            description = "Comma-separated list of group names to leave out of the import, "
+                          "which may contain * and ? wildcards."
+        )
+        weld_vertices: props.BoolProperty(
+            name = "Merge vertices",
+            default = True,
+            description = "Merges vertices at the same position into one, so that faces "
+                          "with different normals or UVs at a shared corner stay connected."
+        )
+        weld_distance: props.FloatProperty(
+            name = "Merge distance",
+            default = 0.0,
+            min = 0.0,
+            description = "Merges vertices that are this close together, snapped to a grid "
+                          "of this size.  Zero only merges vertices with identical positions."
+        )
+        share_meshes: props.BoolProperty(
+            name = "Share identical meshes",
+            default = False,
+            description = "Groups with the same geometry, materials and UVs share a single mesh "
+                          "rather than each getting a copy."
+        )
+        flatten_groups: props.BoolProperty(
+            name = "Flatten empty groups",
+            default = False,
+            description = "Leaves out groups without geometry, transform, tags or other attributes, "
+                          "attaching their children to the group above instead."
+        )
+        merge_by_material: props.BoolProperty(
+            name = "Merge by material",
+            default = False,
+            description = "Merges the static geometry below each group at the merge level into "
+                          "one mesh per material.  Groups with tags, characters, billboards and "
+                          "DCS nodes are kept separate."
+        )
+        merge_level: props.IntProperty(
+            name = "Merge level",
+            default = 1,
+            min = 1,
+            description = "Depth of the groups under which to merge the geometry, where 1 "
+                          "means the top-level groups."
+        )
+        reuse_instances: props.BoolProperty(
+            name = "Reuse instances",
+            default = False,
+            description = "Builds the contents of identical <Instance> groups only once, in a "
+                          "separate collection, and places them as collection instances."
+        )
     else:
         load_external = props.BoolProperty(
             name="Load external references",
@@ -119,6 +188,75 @@ class IMPORT_OT_egg(bpy.types.Operator, ImportHelper):
             default=True,
             description="Automatically tries to bind actions to armatures."
         )
+        legacy_parser = props.BoolProperty(
+            name="Legacy parser",
+            default=False,
+            description="Uses the original character-by-character .egg parser "
+                        "instead of the faster buffer-based one."
+        )
+        memory_map = props.BoolProperty(
+            name="Memory-map files",
+            default=True,
+            description="Parses uncompressed .egg files directly from a memory-mapped view "
+                        "of the file, rather than reading them into memory first."
+        )
+        exclude_types = props.StringProperty(
+            name="Exclude elements",
+            default="",
+            description="Comma-separated list of element types to leave out of the import, "
+                        "such as Table, Collide or NurbsCurve.  Collide excludes whole collision groups."
+        )
+        exclude_groups = props.StringProperty(
+            name="Exclude groups",
+            default="",
+            description="Comma-separated list of group names to leave out of the import, "
+                        "which may contain * and ? wildcards."
+        )
+        weld_vertices = props.BoolProperty(
+            name="Merge vertices",
+            default=True,
+            description="Merges vertices at the same position into one, so that faces "
+                        "with different normals or UVs at a shared corner stay connected."
+        )
+        weld_distance = props.FloatProperty(
+            name="Merge distance",
+            default=0.0,
+            min=0.0,
+            description="Merges vertices that are this close together, snapped to a grid "
+                        "of this size.  Zero only merges vertices with identical positions."
+        )
+        share_meshes = props.BoolProperty(
+            name="Share identical meshes",
+            default=False,
+            description="Groups with the same geometry, materials and UVs share a single mesh "
+                        "rather than each getting a copy."
+        )
+        flatten_groups = props.BoolProperty(
+            name="Flatten empty groups",
+            default=False,
+            description="Leaves out groups without geometry, transform, tags or other attributes, "
+                        "attaching their children to the group above instead."
+        )
+        merge_by_material = props.BoolProperty(
+            name="Merge by material",
+            default=False,
+            description="Merges the static geometry below each group at the merge level into "
+                        "one mesh per material.  Groups with tags, characters, billboards and "
+                        "DCS nodes are kept separate."
+        )
+        merge_level = props.IntProperty(
+            name="Merge level",
+            default=1,
+            min=1,
+            description="Depth of the groups under which to merge the geometry, where 1 "
+                        "means the top-level groups."
+        )
+        reuse_instances = props.BoolProperty(
+            name="Reuse instances",
+            default=False,
+            description="Builds the contents of identical <Instance> groups only once, in a "
+                        "separate collection, and places them as collection instances."
+        )
 
     def execute(self, context):
         context = importer.EggContext()
@@ -126,15 +264,31 @@ class IMPORT_OT_egg(bpy.types.Operator, ImportHelper):
         context.warn = lambda msg: self.report({'WARNING'}, context.prefix_message(msg))
         context.error = lambda msg: self.report({'ERROR'}, context.prefix_message(msg))
         context.search_dir = self.directory
+        context.legacy_parser = self.legacy_parser
+        context.memory_map = self.memory_map
+        context.excluded_types = {type.strip().strip('<>').upper()
+                                  for type in self.exclude_types.split(',') if type.strip()}
+        context.excluded_groups = [pattern.strip()
+                                   for pattern in self.exclude_groups.split(',') if pattern.strip()]
+        context.weld_vertices = self.weld_vertices
+        context.weld_distance = self.weld_distance
+        context.share_meshes = self.share_meshes
+        context.flatten_groups = self.flatten_groups
+        context.merge_by_material = self.merge_by_material
+        context.merge_level = self.merge_level
+        context.reuse_instances = self.reuse_instances
         roots = []
 
         for file in self.files:
             path = os.path.join(self.directory, file.name)
             root = context.read_file(path)
-            roots.append(root)
+            roots.append((path, root))
 
-        for root in roots:
+        for path, root in roots:
+            context.find_repeated_instances(root)
             root.build_tree(context)
+            context.link_objects(path)
+        context.build_armatures()
         context.assign_vertex_groups()
 
         if self.load_external:
@@ -157,6 +311,28 @@ class IMPORT_OT_egg(bpy.types.Operator, ImportHelper):
         row.prop(self, "load_external")
         row = layout.row()
         row.prop(self, "auto_bind")
+        row = layout.row()
+        row.prop(self, "legacy_parser")
+        row = layout.row()
+        row.prop(self, "memory_map")
+        row = layout.row()
+        row.prop(self, "exclude_types")
+        row = layout.row()
+        row.prop(self, "exclude_groups")
+        row = layout.row()
+        row.prop(self, "weld_vertices")
+        row = layout.row()
+        row.prop(self, "weld_distance")
+        row = layout.row()
+        row.prop(self, "share_meshes")
+        row = layout.row()
+        row.prop(self, "flatten_groups")
+        row = layout.row()
+        row.prop(self, "merge_by_material")
+        row = layout.row()
+        row.prop(self, "merge_level")
+        row = layout.row()
+        row.prop(self, "reuse_instances")
 
 
 def menu_func(self, context):
@@ -2,7 +2,15 @@
 and calls begin_child and end_child on the visitor methods as it discovers
 .egg children. """
 
-__all__ = ["parse_egg"]
+__all__ = ["parse_egg", "iterparse", "EggBufferParser", "EggStreamParser", "decompress_chunks", "SKIP", "LineIndex",
+           "parse_numbers", "NUMERIC_TYPES"]
+
+import os
+import re
+import mmap
+import zlib
+from array import array
+from bisect import bisect_right
 
 def skip_whitespace(fp, char):
     """ Returns the next non-whitespace non-comment character. """
@@ -51,10 +59,33 @@ def parse_number(str):
         return float(str)
 
 
+def parse_numbers(values):
+    """ Converts a sequence of numeric str or bytes values to an array of
+    doubles in one go.  Only if that fails because one of them uses a special
+    notation does it fall back to calling parse_number on each value. """
+
+    try:
+        return array('d', map(float, values))
+    except ValueError:
+        return array('d', [parse_number(v if isinstance(v, str) else v.decode('latin-1')) for v in values])
+
+
+# The (upper-case) types of the elements whose values are all numeric.  The
+# parsers pass their values to begin_child as an array of doubles, rather
+# than a list of strings.
+NUMERIC_TYPES = frozenset(('VERTEX', 'NORMAL', 'UV', 'RGBA', 'V'))
+
+
 class EggSyntaxError(Exception):
     pass
 
 
+# A visitor may return this from begin_child to indicate that the element
+# should be skipped.  The parser will then skip over its body without
+# visiting any of its children, and will not call end_child for it.
+SKIP = object()
+
+
 def parse_egg(fp, visitor, context=None):
     read = fp.read
     char = read(1)
@@ -131,12 +162,20 @@ def _parse_egg_element(fp, visitor, context):
         values.append(value)
         char = skip_whitespace(fp, char)
 
+    if type.upper() in NUMERIC_TYPES:
+        values = parse_numbers(values)
+
     if hasattr(visitor, 'begin_child'):
         child = visitor.begin_child(context, type, name, values)
     else:
         child = None
 
-    # Read child elements.
+    # Read child elements.  We still have to read them all if the element is
+    # to be skipped, but at least we don't visit them.
+    skip = child is SKIP
+    if skip:
+        child = None
+
     while char == '<':
         _parse_egg_element(fp, child, context)
 
@@ -144,10 +183,524 @@ def _parse_egg_element(fp, visitor, context):
         char = read(1)
         char = skip_whitespace(fp, char)
 
-    if hasattr(visitor, 'end_child'):
+    if hasattr(visitor, 'end_child') and not skip:
         visitor.end_child(context, type, name, child)
 
     if not char:
         raise EggSyntaxError("parsing <%s> %s: reached end-of-file while parsing body" % (type, name))
     elif char != '}':
         raise EggSyntaxError("parsing <%s> %s: expected < or }, not %s" % (char))
+
+
+# Regular expressions used by EggBufferParser.  Comments are only recognized
+# at the start of a token, like in skip_whitespace.
+_space = r'(?:\s+|//[^\n]*|/\*.*?\*/)*'
+_values = r'[^<{}"/]*(?:(?:(?<=[^\s{}"])/|/(?![/*]))[^<{}"/]*)*'
+
+# Matches the rest of an element body up to and including its closing brace,
+# as long as it nests no deeper than a fixed number of levels and contains
+# no comments.
+_body = r'[^{}"/]*'
+for i in range(8):
+    _body = r'[^{}"/]*(?:(?:"[^"]*"|\{' + _body + r'\})[^{}"/]*)*'
+_body += r'\}'
+
+
+class _EggSyntax:
+    """ The compiled regular expressions and delimiters used for scanning
+    either str or bytes buffers. """
+
+    def __init__(self, cast):
+        self.skip = re.compile(cast(_space), re.S)
+        self.type = re.compile(cast(r'<([^>]*)>'))
+        self.quoted = re.compile(cast(r'"([^"]*)"'))
+        self.word = re.compile(cast(r'[^\s{}"]+'))
+        self.values = re.compile(cast(_values))
+        self.close = re.compile(cast(r'\}' + _space), re.S)
+
+        # Matches the common case of an element head in one go: the type, an
+        # optional name, the opening brace and the run of unquoted values.
+        self.head = re.compile(cast(r'<([^>]*)>' + _space + r'(?:"([^"]*)"|([^\s{}"]+))?' +
+                                    _space + r'\{(' + _values + ')'), re.S)
+
+        self.body = re.compile(cast(_body))
+
+        # Finds the next brace that isn't part of a string or comment.  The
+        # strings and comments may be cut off by the end of the buffer.
+        self.brace = re.compile(cast(r'[{}]|"[^"]*"?|(?<![^\s{}"])(?://[^\n]*|/\*(?:.*?\*/|.*))'), re.S)
+
+        self.lt, self.lbrace, self.rbrace, self.quote, self.slash = \
+            (cast(c) for c in '<{}"/')
+
+_str_syntax = _EggSyntax(str)
+_bytes_syntax = _EggSyntax(str.encode)
+
+
+class LineIndex:
+    """ Keeps a sorted index of the offsets of the newlines in a file, so that
+    the line number of any offset can be found with a binary search.  The
+    index is extended incrementally as the parser advances through the file,
+    so each lookup costs O(log n) instead of a scan from the start. """
+
+    _str_newline = re.compile('\n')
+    _bytes_newline = re.compile(b'\n')
+
+    def __init__(self):
+        self.offsets = array('q')
+
+        # Everything before this offset has been indexed.
+        self.end = 0
+
+        # The number of newlines before the first offset in the index.
+        self.lines = 0
+
+    def update(self, data, end, base=0):
+        """ Indexes the newlines up to the given offset.  data holds the file
+        contents starting at offset base. """
+
+        if end <= self.end:
+            return
+
+        if isinstance(data, str):
+            newline = self._str_newline
+        else:
+            newline = self._bytes_newline
+
+        self.offsets.extend([m.start() + base for m in newline.finditer(data, self.end - base, end - base)])
+        self.end = end
+
+    def discard(self, data, offset, base=0):
+        """ Forgets the newlines before offset, so that the index only covers
+        the part of the file that is still held in memory.  Newlines that
+        were not indexed yet are merely counted. """
+
+        count = bisect_right(self.offsets, offset - 1)
+        if count:
+            del self.offsets[:count]
+            self.lines += count
+
+        if offset > self.end:
+            newline = '\n' if isinstance(data, str) else b'\n'
+            self.lines += data.count(newline, self.end - base, offset - base)
+            self.end = offset
+
+    def get_lineno(self, offset):
+        """ Returns the line number (starting at 1) containing offset, which
+        must have been indexed. """
+
+        return self.lines + bisect_right(self.offsets, offset - 1) + 1
+
+
+class EggBufferParser:
+    """ Parses .egg data that is held entirely in memory.  Rather than reading
+    one character at a time, like parse_egg does, this scans the buffer using
+    compiled regular expressions, so that a whole element head including its
+    run of values is extracted with a single match.  It calls begin_child and
+    end_child on the visitor objects in the same way as parse_egg.
+
+    The data may be a str, or a bytes-like object such as an mmap, in which
+    case only the extracted types, names and values are decoded. """
+
+    # Subclasses that receive their data piecemeal set this to False, and
+    # implement _refill to make more data available.
+    eof = True
+
+    # How much data should be buffered ahead of each element.
+    reserve = 4096
+
+    def __init__(self, data, encoding='utf-8'):
+        self.data = data
+        self.pos = 0
+        self.encoding = encoding
+        self.binary = not isinstance(data, str)
+        self._syntax = _bytes_syntax if self.binary else _str_syntax
+
+        # The offset of self.data in the file, in case the start of the file
+        # has already been discarded.
+        self._base = 0
+
+        # The newline offsets, indexed up to where the parser has been.
+        self._line_index = LineIndex()
+
+        self._skip_requested = False
+
+    def tell(self):
+        """ Returns the position of the element currently being parsed. """
+
+        return self._base + self.pos
+
+    def getvalue(self):
+        """ Returns the data being parsed, like StringIO.getvalue().  For a
+        stream, this is only the part that is still buffered. """
+
+        return self.data
+
+    def get_lineno(self):
+        """ Returns the line number of the element currently being parsed. """
+
+        offset = self._base + self.pos
+        self._line_index.update(self.data, offset, self._base)
+        return self._line_index.get_lineno(offset)
+
+    def _decode(self, value):
+        if self.binary:
+            return value.decode(self.encoding)
+        return value
+
+    def _refill(self, pos, size):
+        """ Discards the data before pos, and appends at least size bytes of
+        new data, or sets eof if there is none.  Returns the new value of pos.
+        """
+
+        raise NotImplementedError
+
+    def _skip(self, pos):
+        """ Returns the position of the next token at or after pos. """
+
+        skip_match = self._syntax.skip.match
+        end = skip_match(self.data, pos).end()
+
+        # If the whitespace or comment may continue past the end of the
+        # buffer, we need to start over with more data.
+        while not self.eof and (end >= len(self.data) or self.data[end:end + 1] == self._syntax.slash):
+            pos = self._refill(pos, len(self.data))
+            end = skip_match(self.data, pos).end()
+
+        return end
+
+    def skip(self):
+        """ May be called while handling a 'start' event from iterparse, to
+        skip over the body of that element without tokenizing it.  The 'end'
+        event for the element is still generated. """
+
+        self._skip_requested = True
+
+    def parse(self, visitor, context=None):
+        stack = []
+        for event, type, name, values in self.iterparse():
+            if event == 'start':
+                begin_child = getattr(visitor, 'begin_child', None)
+                if begin_child is not None:
+                    child = begin_child(context, type, name, values)
+                    if child is SKIP:
+                        self.skip()
+                else:
+                    child = None
+
+                stack.append((visitor, child))
+                visitor = child
+            else:
+                visitor, child = stack.pop()
+
+                end_child = getattr(visitor, 'end_child', None)
+                if end_child is not None and child is not SKIP:
+                    end_child(context, type, name, child)
+
+    def iterparse(self, skip=()):
+        """ Yields a ('start', type, name, values) tuple when an element is
+        opened, and an ('end', type, name, None) tuple when it is closed.
+        The bodies of elements whose upper-case type is in skip are skipped
+        over, as though skip() had been called for them.
+
+        The values of elements in NUMERIC_TYPES are an array of doubles, the
+        values of other elements a list of strings. """
+
+        syntax = self._syntax
+        binary = self.binary
+        encoding = self.encoding
+        head_match = syntax.head.match
+        close_match = syntax.close.match
+        lt = syntax.lt
+        rbrace = syntax.rbrace
+        quote = syntax.quote
+        slash = syntax.slash
+
+        # Maps the raw type to the decoded type, and whether it is numeric.
+        # There are only a handful of distinct types.
+        types = {}
+
+        pos = self._skip(self.pos)
+        data = self.data
+        char = data[pos:pos + 1]
+        eof = self.eof
+
+        # Rather than recursing, keep a stack of the elements that are open.
+        stack = []
+        while True:
+            if not eof and len(data) - pos < self.reserve:
+                # Make sure that the next element head is likely buffered.
+                pos = self._refill(pos, self.reserve)
+                data = self.data
+                eof = self.eof
+
+            if char == lt:
+                # Try the common case first, falling back to _read_head for
+                # anything that the head regex can't handle on its own.
+                m = head_match(data, pos)
+                if m is not None and m.end() < len(data) and data[m.end():m.end() + 1] not in (quote, slash):
+                    type, name, word, run = m.groups()
+                    if name is None:
+                        name = word or run[:0]
+                    kind = types.get(type)
+                    if kind is None:
+                        kind = self._decode(type)
+                        kind = types[type] = (kind, kind.upper() in NUMERIC_TYPES)
+                    type, numeric = kind
+                    if binary:
+                        name = name.decode(encoding) if name else ''
+                        if not numeric:
+                            run = run.decode(encoding)
+                    values = run.split()
+                    pos = m.end()
+                else:
+                    try:
+                        type, name, values, end = self._read_head(pos)
+                    except EggSyntaxError:
+                        if eof:
+                            raise
+                        end = len(data)
+
+                    if end >= len(data) and not eof:
+                        # It may continue past the end of the buffer.
+                        pos = self._refill(pos, len(data))
+                        data = self.data
+                        eof = self.eof
+                        continue
+                    pos = end
+                    numeric = type.upper() in NUMERIC_TYPES
+
+                self.pos = pos
+                if numeric:
+                    values = parse_numbers(values)
+                stack.append((type, name))
+                yield ('start', type, name, values)
+
+                if self._skip_requested or (skip and type.upper() in skip):
+                    self._skip_requested = False
+                    pos = self._skip_body(pos, type, name)
+                    data = self.data
+                    eof = self.eof
+
+            elif stack:
+                end = close_match(data, pos).end() if char == rbrace else pos
+                if not eof and (end >= len(data) or data[end:end + 1] == slash):
+                    # The whitespace or comment after the closing brace may
+                    # continue past the end of the buffer.
+                    pos = self._refill(pos, len(data))
+                    data = self.data
+                    eof = self.eof
+                    continue
+
+                type, name = stack.pop()
+                self.pos = pos
+                yield ('end', type, name, None)
+
+                if not char:
+                    raise EggSyntaxError("parsing <%s> %s: reached end-of-file while parsing body" % (type, name))
+                elif char != rbrace:
+                    raise EggSyntaxError("parsing <%s> %s: expected < or }, not %s" % (type, name, self._decode(char)))
+
+                # Skip spaces after the closing brace.
+                pos = end
+
+            else:
+                break
+
+            char = data[pos:pos + 1]
+
+        self.pos = pos
+        if char:
+            raise EggSyntaxError("expected EOF or <, not %s" % (self._decode(char)))
+
+    def _skip_body(self, pos, type, name):
+        """ Returns the position of the brace that closes the body of the
+        given element, which continues at pos, by only matching up braces. """
+
+        data = self.data
+        m = self._syntax.body.match(data, pos)
+        if m is not None:
+            return m.end() - 1
+
+        # Something more complicated; go through it brace by brace.
+        brace_search = self._syntax.brace.search
+        lbrace = self._syntax.lbrace
+        rbrace = self._syntax.rbrace
+
+        depth = 1
+        while True:
+            m = brace_search(data, pos)
+            if m is None:
+                if self.eof:
+                    self.pos = len(data)
+                    raise EggSyntaxError("parsing <%s> %s: reached end-of-file while skipping body" % (type, name))
+
+                # Nothing of interest left in the buffer; discard it, except
+                # for the last character, which may be part of a word.  If it
+                # is a slash, it may also start a comment, so scan it again.
+                keep = 0 if data[-1:] == self._syntax.slash else 1
+                pos = self._refill(len(data) - 1, self.reserve) + keep
+                data = self.data
+                continue
+
+            token = m.group()
+            if token == rbrace:
+                depth -= 1
+                if depth == 0:
+                    return m.start()
+            elif token == lbrace:
+                depth += 1
+            elif m.end() >= len(data) and not self.eof:
+                # A string or comment that may continue past the end of the
+                # buffer.  Try again with more data.
+                pos = self._refill(m.start(), len(data))
+                data = self.data
+                continue
+
+            pos = m.end()
+
+    def _read_head(self, pos):
+        """ Reads the type, name and the values directly underneath the
+        element starting at pos, which should point to a < character.  Returns
+        these along with the position of the first child element or the
+        closing brace. """
+
+        data = self.data
+        syntax = self._syntax
+        decode = self._decode
+
+        m = syntax.head.match(data, pos)
+        if m is not None:
+            type, name, word, run = m.groups()
+            type = decode(type)
+            name = decode(name if name is not None else word or run[:0])
+            values = decode(run).split()
+            pos = m.end()
+        else:
+            # Something unusual; go through it step by step, so that we can
+            # produce a sensible error message.
+            m = syntax.type.match(data, pos)
+            if m is None:
+                self.pos = pos
+                raise EggSyntaxError("reached end-of-file while parsing element type")
+            type = decode(m.group(1))
+
+            # Now check for a name.
+            pos = syntax.skip.match(data, m.end()).end()
+            char = data[pos:pos + 1]
+            name = ''
+            if char == syntax.quote:
+                m = syntax.quoted.match(data, pos)
+            elif char != syntax.lbrace:
+                m = syntax.word.match(data, pos)
+            else:
+                m = None
+
+            if m is not None:
+                name = decode(m.group(m.lastindex or 0))
+                pos = syntax.skip.match(data, m.end()).end()
+                char = data[pos:pos + 1]
+
+            if char != syntax.lbrace:
+                self.pos = pos
+                raise EggSyntaxError("parsing <%s> %s: expected {, not %s" % (type, name, decode(char)))
+
+            values = []
+            pos += 1
+
+        # The run of values may be interrupted by quoted strings or comments.
+        while True:
+            m = syntax.values.match(data, pos)
+            if m.end() != pos:
+                values += decode(m.group()).split()
+                pos = m.end()
+
+            char = data[pos:pos + 1]
+            if char == syntax.quote:
+                m = syntax.quoted.match(data, pos)
+                if m is None:
+                    self.pos = pos
+                    raise EggSyntaxError("parsing <%s> %s: reached end-of-file while parsing string" % (type, name))
+                values.append(decode(m.group(1)))
+                pos = m.end()
+            elif char == syntax.slash:
+                end = syntax.skip.match(data, pos).end()
+                if end == pos:
+                    self.pos = pos
+                    raise EggSyntaxError("parsing <%s> %s: reached end-of-file while parsing comment" % (type, name))
+                pos = end
+            else:
+                return type, name, values, pos
+
+
+class EggStreamParser(EggBufferParser):
+    """ Parses .egg data that is delivered as an iterable of bytes chunks, such
+    as produced by decompress_chunks.  Only a window of the data around the
+    current element is kept in memory, so memory use is bounded by the chunk
+    size rather than by the size of the file. """
+
+    eof = False
+
+    def __init__(self, chunks, encoding='utf-8'):
+        EggBufferParser.__init__(self, b'', encoding)
+        self._chunks = iter(chunks)
+
+    def _refill(self, pos, size):
+        data = self.data
+        base = self._base
+        self._line_index.discard(data, base + pos, base)
+        self._base = base + pos
+        self.pos = max(self.pos - pos, 0)
+
+        buffer = [data[pos:]]
+        added = 0
+        for chunk in self._chunks:
+            buffer.append(chunk)
+            added += len(chunk)
+            if added >= size:
+                break
+        else:
+            self.eof = True
+
+        self.data = b''.join(buffer)
+        return 0
+
+
+def decompress_chunks(path, chunk_size=1 << 16):
+    """ Yields the decompressed contents of a .pz or .gz file in chunks of
+    at most chunk_size bytes. """
+
+    decompressor = zlib.decompressobj(32 + 15)
+    with open(path, 'rb') as fp:
+        while not decompressor.eof:
+            data = decompressor.unconsumed_tail or fp.read(chunk_size)
+            if not data:
+                raise zlib.error("incomplete or truncated stream")
+
+            chunk = decompressor.decompress(data, chunk_size)
+            if chunk:
+                yield chunk
+
+
+def iterparse(path, skip=(), encoding='utf-8'):
+    """ Yields a ('start', type, name, values) tuple for every element that is
+    opened in the given .egg file, and an ('end', type, name, None) tuple for
+    every element that is closed, without building up any object model.
+    Uncompressed files are memory-mapped, and compressed files are
+    decompressed as they are parsed, so memory use does not grow with the
+    size of the file.
+
+    The bodies of elements with a type in skip, such as 'VertexPool', are
+    passed over without being tokenized. """
+
+    skip = frozenset(type.upper() for type in skip)
+
+    if path.endswith('.pz') or path.endswith('.gz'):
+        yield from EggStreamParser(decompress_chunks(path), encoding).iterparse(skip)
+        return
+
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from EggBufferParser(data, encoding).iterparse(skip)
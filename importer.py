@@ -1,11 +1,14 @@
 """ This files contains classes that interpret the .egg object model and write
 out the appropriate Blender structures. """
 
-from .eggparser import parse_egg, parse_number
+from .eggparser import parse_egg, parse_number, EggBufferParser, EggStreamParser, decompress_chunks, SKIP, LineIndex
 
 import sys, os
 import bpy
-import io, zlib
+import io, zlib, mmap, hashlib
+import numpy
+from array import array
+from fnmatch import fnmatchcase
 from mathutils import Matrix, Vector
 from math import radians, sqrt
 
@@ -39,6 +42,43 @@ class EggContext:
         self.search_dir = None
 
         self.current_file = None
+        self.current_line_index = None
+
+        # Set this to use the original character-by-character parser.
+        self.legacy_parser = False
+
+        # Whether to parse uncompressed files from a memory-mapped view.
+        self.memory_map = True
+
+        # Element types (in upper case) and group name patterns to leave out
+        # of the import altogether.
+        self.excluded_types = set()
+        self.excluded_groups = []
+
+        # Whether to merge vertices that share a position, and the size of the
+        # grid cells used for merging, or zero to merge exact matches only.
+        self.weld_vertices = True
+        self.weld_distance = 0.0
+
+        # Whether groups with identical geometry share one mesh, and the
+        # meshes built so far, indexed by a hash of their contents.
+        self.share_meshes = False
+        self.shared_meshes = {}
+
+        # Whether to leave out groups that only contain other groups.
+        self.flatten_groups = False
+
+        # Whether to build <Instance> groups with identical contents as
+        # instances of one collection.  Maps the repeated instances to a hash
+        # of their contents, and each hash to its collection.
+        self.reuse_instances = False
+        self.repeated_instances = {}
+        self.instance_collections = {}
+
+        # Whether to merge the static geometry below the groups at the given
+        # level of the hierarchy into one mesh per material.
+        self.merge_by_material = False
+        self.merge_level = 1
 
         self.duplicate_faces = 0
         self.degenerate_faces = 0
@@ -57,6 +97,16 @@ class EggContext:
         # We remember all the Group/VertexRef entries, so we can assign them
         # in a separate pass.
         self.group_vertex_refs = []
+        # The names of the pools referenced by those, built on first use.
+        self.weighted_pools = None
+
+        # The objects created by build_tree that still need to be linked into
+        # the scene, with whether they should be selected.
+        self.new_objects = []
+
+        # The groups with a <Dart> flag, with their armature objects, waiting
+        # for their bones to be created.
+        self.armatures = []
 
         self.joints = {}
         self.bundle_actions = {}
@@ -65,19 +115,44 @@ class EggContext:
     def read_file(self, path):
         """ Reads an .egg file, returning a root EggGroupNode. """
 
+        file = None
         if path.endswith('.pz') or path.endswith('.gz'):
-            data = zlib.decompress(open(path, 'rb').read(), 32 + 15).decode('utf-8')
-        elif not os.path.isfile(path) and not os.path.splitext(path)[1]:
-            # Implicit .egg extension.
-            data = open(path + '.egg', 'r').read()
+            if self.legacy_parser:
+                data = zlib.decompress(open(path, 'rb').read(), 32 + 15).decode('utf-8')
+            else:
+                # Decompress while parsing, rather than all up front.
+                data = decompress_chunks(path)
+        else:
+            if not os.path.isfile(path) and not os.path.splitext(path)[1]:
+                # Implicit .egg extension.
+                path += '.egg'
+
+            if self.memory_map and not self.legacy_parser:
+                # Parse the raw bytes straight from the mapped file, so that
+                # we never hold a decoded copy of the whole file in memory.
+                file = open(path, 'rb')
+                if os.fstat(file.fileno()).st_size > 0:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = b''
+            else:
+                data = open(path, 'r').read()
+
+        if self.legacy_parser:
+            buffer = io.StringIO(data)
+        elif isinstance(data, (str, bytes, mmap.mmap)):
+            buffer = EggBufferParser(data)
         else:
-            data = open(path, 'r').read()
+            buffer = EggStreamParser(data)
 
-        buffer = io.StringIO(data)
         root = EggGroupNode()
         self.current_file = buffer
+        self.current_line_index = None
         try:
-            parse_egg(buffer, root, self)
+            if self.legacy_parser:
+                parse_egg(buffer, root, self)
+            else:
+                buffer.parse(root, self)
         except Exception as ex:
             lineno = self.get_current_lineno()
             self.current_file = None
@@ -87,17 +162,47 @@ class EggContext:
             raise
         finally:
             self.current_file = None
-        buffer.close()
+            self.current_line_index = None
+            if file:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+                file.close()
+
+        if self.legacy_parser:
+            buffer.close()
 
         return root
 
+    def is_excluded(self, type, name):
+        """ Returns true if the given element should be skipped entirely.
+        The type is expected to be in upper case. """
+
+        if type in self.excluded_types:
+            return True
+
+        if self.excluded_groups and type in ('GROUP', 'INSTANCE'):
+            for pattern in self.excluded_groups:
+                if fnmatchcase(name, pattern):
+                    return True
+
+        return False
+
     def get_current_lineno(self):
         """ Returns the current line number. """
 
-        if self.current_file:
-            charno = self.current_file.tell()
-            lineno = self.current_file.getvalue()[:charno].count('\n') + 1
-            return lineno
+        if isinstance(self.current_file, EggBufferParser):
+            return self.current_file.get_lineno()
+        elif self.current_file:
+            index = self.current_line_index
+            if index is None:
+                # Index the whole file the first time, so that further
+                # lookups don't need to go over the contents again.
+                value = self.current_file.getvalue()
+                index = LineIndex()
+                index.update(value, len(value))
+                self.current_line_index = index
+
+            return index.get_lineno(self.current_file.tell())
 
     def prefix_message(self, msg):
         """ Returns a formatted error message, possibly prefixed with line
@@ -215,28 +320,172 @@ class EggContext:
         return image
 
     def assign_vertex_groups(self):
-        """ Called at the end, to assign all of the vertex groups. """
+        """ Called at the end, to assign all of the vertex groups.  The
+        references are first remapped to Blender vertices and collected in
+        buckets by mesh, joint and weight, so that each bucket takes only a
+        single call to add its vertices to the vertex group. """
+
+        # Arrays mapping each pool index to a Blender vertex, or -1, indexed
+        # by (pool, group).
+        vertex_maps = {}
+        buckets = {}
 
         for name, vertex_ref in self.group_vertex_refs:
-            vpool = self.vertex_pools[vertex_ref.pool]
+            vpool = self.vertex_pools.get(vertex_ref.pool)
+            if vpool is None:
+                continue
+
+            indices = numpy.frombuffer(vertex_ref.indices, dtype=numpy.int32)
+            indices = indices[(indices >= 0) & (indices < len(vpool))]
+
             for group in vpool.groups:
+                if group.mesh_object is None:
+                    continue
+
                 vertex_groups = group.mesh_object.vertex_groups
-                if name in vertex_groups:
-                    vertex_group = vertex_groups[name]
-                else:
-                    vertex_group = vertex_groups.new(name=name)
+                if name not in vertex_groups:
+                    vertex_groups.new(name=name)
 
                 # Remap the indices to this object.
-                indices = set()
-                for index in vertex_ref.indices:
-                    vertex = vpool[index]
-                    if vertex in group.vertices:
-                        indices.add(group.vertices[vertex])
-
-                if indices:
-                    vertex_group.add(tuple(indices), vertex_ref.membership, 'ADD')
+                vertex_map = vertex_maps.get((vpool, group))
+                if vertex_map is None:
+                    vertex_map = group.get_vertex_map(vpool)
+                    vertex_maps[(vpool, group)] = vertex_map
+
+                bverts = numpy.unique(vertex_map[indices])
+                bverts = bverts[bverts >= 0]
+                if len(bverts):
+                    buckets.setdefault((group, name, vertex_ref.membership), []).append(bverts)
+
+        for (group, name, weight), arrays in buckets.items():
+            vertex_group = group.mesh_object.vertex_groups[name]
+            if len(arrays) == 1:
+                vertex_group.add(arrays[0].tolist(), weight, 'ADD')
+                continue
+
+            # A vertex referenced more than once gets the weight added again
+            # for each reference.
+            bverts, counts = numpy.unique(numpy.concatenate(arrays), return_counts=True)
+            for count in numpy.unique(counts):
+                subset = bverts[counts == count].tolist()
+                for i in range(count):
+                    vertex_group.add(subset, weight, 'ADD')
 
         self.group_vertex_refs.clear()
+        self.weighted_pools = None
+
+    def is_weighted_pool(self, vpool):
+        """ Returns true if any vertices of the given pool are assigned to a
+        joint by a <VertexRef> in a <Joint> or <Group>. """
+
+        if self.weighted_pools is None:
+            self.weighted_pools = {vertex_ref.pool for name, vertex_ref in self.group_vertex_refs}
+        return vpool.name in self.weighted_pools
+
+    def find_repeated_instances(self, root):
+        """ Finds the <Instance> groups below the given node that have the
+        same contents as another one, so that build_tree can build their
+        contents once and instance them. """
+
+        if not self.reuse_instances or bpy.app.version < (2, 80):
+            return
+
+        keys = {}
+        counts = {}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, EggGroup):
+                if node.dart:
+                    continue
+                if node.instance_type:
+                    key = node.get_content_key()
+                    if key is not None:
+                        keys[node] = key
+                        counts[key] = counts.get(key, 0) + 1
+
+            if isinstance(node, EggGroupNode):
+                stack.extend(node.children)
+
+        for node, key in keys.items():
+            if counts[key] > 1:
+                self.repeated_instances[node] = key
+
+    def link_objects(self, path):
+        """ Links the objects created by build_tree into the current scene, in
+        a new collection named after the given file.  The collection is only
+        linked into the scene once it has been filled, so that the view layer
+        is updated once rather than for every object.  Before 2.80, the
+        objects have already been linked by build_tree. """
+
+        if bpy.app.version < (2, 80):
+            return
+
+        name = os.path.basename(path)
+        for ext in ('.pz', '.gz', '.egg'):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+
+        collection = bpy.data.collections.new(name)
+        for object, select in self.new_objects:
+            collection.objects.link(object)
+
+        bpy.context.scene.collection.children.link(collection)
+        for object, select in self.new_objects:
+            if select:
+                object.select_set(True)
+
+        self.new_objects.clear()
+
+    def build_armatures(self):
+        """ Creates the bones of the armatures added by build_tree.  Bones can
+        only be created in edit mode, so all of the armatures are put into
+        edit mode together, where Blender supports that. """
+
+        if not self.armatures:
+            return
+
+        if bpy.app.version >= (2, 80):
+            # mode_set works on all selected objects, so select only the
+            # armatures, and restore the selection afterwards.
+            view_layer = bpy.context.view_layer
+            active = view_layer.objects.active
+            selected = list(view_layer.objects.selected)
+            for object in selected:
+                object.select_set(False)
+
+            view_layer.objects.active = self.armatures[0][1]
+            for group, object in self.armatures:
+                object.select_set(True)
+
+            bpy.ops.object.mode_set(mode='EDIT')
+            for group, object in self.armatures:
+                group.build_armature(self, object, None, Matrix())
+            bpy.ops.object.mode_set(mode='OBJECT')
+
+            for group, object in self.armatures:
+                object.select_set(False)
+            for object in selected:
+                object.select_set(True)
+            view_layer.objects.active = active
+        else:
+            scene = bpy.context.scene
+            active = scene.objects.active
+            for group, object in self.armatures:
+                scene.objects.active = object
+                bpy.ops.object.mode_set(mode='EDIT')
+                group.build_armature(self, object, None, Matrix())
+                bpy.ops.object.mode_set(mode='OBJECT')
+
+            scene.objects.active = active
+
+        # If any of the joints below an armature define a DefaultPose, apply
+        # this to the pose bones.
+        for group, object in self.armatures:
+            if group.has_default_pose:
+                group.apply_default_pose(self, object.pose)
+
+        self.armatures.clear()
 
     def get_external_group(self, path):
         """ Returns the group used for an external reference. """
@@ -275,7 +524,10 @@ class EggContext:
             path = os.path.join(orig_search_dir, path)
             self.search_dir = os.path.dirname(path)
             root = self.read_file(path)
+            self.find_repeated_instances(root)
             root.build_tree(self)
+            self.link_objects(path)
+            self.build_armatures()
             self.assign_vertex_groups()
 
             # Assign all objects in the loaded scene to the group.
@@ -954,82 +1206,147 @@ class EggTransform:
                         (v[3], v[7], v[11], v[15]))), self.matrix)
 
 
-class EggVertex:
-    __slots__ = 'pos', 'normal', 'color', 'uv_map', 'aux_map', 'dxyzs'
+class EggVertexColumn:
+    """ Holds one attribute of all the vertices in a pool, as a flat array
+    with a fixed number of components per vertex.  Vertices that don't
+    define the attribute hold the default value, and have a zero in the mask.
+    The column only grows as far as the highest vertex that defines it. """
 
-    def __init__(self, pos):
-        self.pos = pos
-        self.normal = None
-        self.color = None
-        self.uv_map = {}
-        self.aux_map = {}
-        self.dxyzs = {}
+    __slots__ = 'size', 'default', 'data', 'mask'
 
-    def begin_child(self, context, type, name, values):
-        type = type.upper()
+    def __init__(self, typecode, default):
+        self.size = len(default)
+        self.default = array(typecode, default)
+        self.data = array(typecode)
+        self.mask = bytearray()
 
-        if type == 'NORMAL':
-            self.normal = tuple(parse_number(v) for v in values)
+    def __len__(self):
+        return len(self.mask)
 
-        elif type == 'RGBA':
-            self.color = tuple(parse_number(v) for v in values)
+    def resize(self, count):
+        """ Pads the column with default values up to the given number of
+        vertices. """
 
-        elif type == 'UV':
-            self.uv_map[name or DEFAULT_UV_NAME] = [parse_number(v) for v in values]
+        extra = count - len(self.mask)
+        if extra > 0:
+            self.data.extend(self.default * extra)
+            self.mask.extend(bytes(extra))
 
-        elif type == 'AUX':
-            self.aux_map[name] = [parse_number(v) for v in values]
+    def set(self, index, values):
+        self.resize(index + 1)
+        values = values[:self.size]
+        start = index * self.size
+        self.data[start:start + len(values)] = array(self.data.typecode, values)
+        self.mask[index] = 1
 
-        elif type == 'DXYZ':
-            if not name:
-                name = values.pop(0)
-            self.dxyzs[name] = tuple(parse_number(v) for v in values)
+    def get(self, index):
+        """ Returns the value for the given vertex as a tuple, or None if it
+        doesn't define one. """
 
-    def __hash__(self):
-        return hash(self.pos)
+        if 0 <= index < len(self.mask) and self.mask[index]:
+            start = index * self.size
+            return tuple(self.data[start:start + self.size])
+        return None
 
-    def __eq__(self, other):
-        return self.pos == other.pos
+    def take(self, indices):
+        """ Returns the values and the mask of the vertices with the given
+        indices, as numpy arrays. """
 
-    def __ne__(self, other):
-        return self.pos != other.pos
+        typecode = self.data.typecode
+        values = numpy.tile(numpy.frombuffer(self.default, dtype=typecode), (len(indices), 1))
+        mask = numpy.zeros(len(indices), dtype=numpy.uint8)
+        if len(self.mask):
+            inside = indices < len(self.mask)
+            data = numpy.frombuffer(self.data, dtype=typecode).reshape(-1, self.size)
+            values[inside] = data[indices[inside]]
+            mask[inside] = numpy.frombuffer(self.mask, dtype=numpy.uint8)[indices[inside]]
+        return values, mask
 
 
 class EggVertexPool:
+    """ Stores the vertices of a <VertexPool> in columns, one per attribute,
+    rather than as one object per vertex.  Morph offsets and auxiliary data,
+    which only a few vertices tend to have, are kept in sparse dictionaries
+    mapping the vertex index to the value. """
+
     def __init__(self, name):
         self.name = name
-        self._vertices = []
         self.groups = set()
 
-    def __getitem__(self, index):
-        if index < 0:
-            raise IndexError
-        vertex = self._vertices[index]
-        if not vertex:
-            raise IndexError
-        return vertex
+        # The mask of the positions indicates which vertices are defined.
+        self.positions = EggVertexColumn('d', (0.0, 0.0, 0.0))
+        self.normals = EggVertexColumn('f', (0.0, 0.0, 0.0))
+        self.colors = EggVertexColumn('f', (1.0, 1.0, 1.0, 1.0))
+        self.uvs = {}
+        self.aux = {}
+        self.dxyzs = {}
 
-    def begin_child(self, context, type, name, values):
-        if type.upper() != 'VERTEX':
-            assert False
+        # The number of indices below len(self) that aren't defined.
+        self.holes = 0
 
-        return EggVertex(tuple(parse_number(v) for v in values))
+        # The vertex whose attributes are currently being parsed.
+        self.current_index = None
 
-    def end_child(self, context, type, name, vertex):
-        verts = self._vertices
-        if name:
-            # Add the vertex at the requested index.
-            num_vertices = len(verts)
-            index = int(name)
-            if index < num_vertices:
-                assert verts[index] is None
-                verts[index] = vertex
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, index):
+        """ Returns true if the vertex with the given index is defined. """
+
+        return self.positions.get(index) is not None
+
+    def find_undefined(self, indices):
+        """ Returns the first of the given indices that doesn't refer to a
+        defined vertex, or None if they are all valid. """
+
+        if indices and (min(indices) < 0 or max(indices) >= len(self.positions) or self.holes):
+            for index in indices:
+                if index not in self:
+                    return index
+        return None
+
+    def begin_child(self, context, type, name, values):
+        type = type.upper()
+
+        if type == 'VERTEX':
+            count = len(self.positions)
+            if name:
+                # Add the vertex at the requested index.
+                index = int(name)
+                if index < count:
+                    assert index not in self
+                    self.holes -= 1
+                else:
+                    self.holes += index - count
             else:
-                if index != num_vertices:
-                    verts.extend([None] * (index - num_vertices))
-                verts.append(vertex)
-        else:
-            verts.append(vertex)
+                index = count
+
+            self.positions.set(index, values)
+            self.current_index = index
+            return self # To catch the vertex attributes
+
+        index = self.current_index
+        if type == 'NORMAL':
+            self.normals.set(index, values)
+
+        elif type == 'RGBA':
+            self.colors.set(index, values)
+
+        elif type == 'UV':
+            name = name or DEFAULT_UV_NAME
+            column = self.uvs.get(name)
+            if column is None:
+                column = EggVertexColumn('f', (0.0, 0.0))
+                self.uvs[name] = column
+            column.set(index, values)
+
+        elif type == 'AUX':
+            self.aux.setdefault(name, {})[index] = tuple(parse_number(v) for v in values)
+
+        elif type == 'DXYZ':
+            if not name:
+                name = values.pop(0)
+            self.dxyzs.setdefault(name, {})[index] = tuple(parse_number(v) for v in values)
 
 
 class EggPrimitive:
@@ -1064,94 +1381,100 @@ class EggPrimitive:
                 self.alpha_mode = values[0].lower().replace('-', '_')
 
         elif type == 'TREF':
-            self.textures.append(context.textures[values[0]])
+            # The texture may be missing if it was excluded from the import.
+            tex = context.textures.get(values[0])
+            if tex is not None:
+                self.textures.append(tex)
 
         elif type == 'MREF':
-            self.material = context.materials[values[0]]
+            self.material = context.materials.get(values[0], self.material)
 
         elif type == 'NORMAL':
-            self.normal = tuple(parse_number(v) for v in values)
+            self.normal = tuple(values)
 
         elif type == 'RGBA':
-            self.color = tuple(parse_number(v) for v in values)
+            self.color = tuple(values)
 
 
-class EggTriangleStrip(EggPrimitive):
+class EggCompositePrimitive(EggPrimitive):
+    """ Base class for primitives that consist of a series of triangles.
+    The indices hold the vertex indices of all the triangles, three for each,
+    and components maps the index of a triangle to a primitive holding its
+    attributes, for only those triangles that have a <Component> entry. """
 
     __slots__ = 'components'
 
     def begin_child(self, context, type, name, values):
         if type.upper() == 'VERTEXREF':
-            indices = [int(v) for v in values]
-            self.indices = tuple(indices)
-            self.components = []
-            prevprev = indices.pop(0)
-            prev = indices.pop(0)
-            flip = False
-            while indices:
-                index = indices.pop(0)
-                prim = EggPrimitive()
-                # I don't think the flipping is truly necessary for Blender.
-                if flip:
-                    prim.indices = [prev, prevprev, index]
-                    flip = False
-                else:
-                    prim.indices = [prevprev, prev, index]
-                    flip = True
-                # It's fine to copy over the attributes, since the .egg syntax
-                # only allows per-component settings after the <VertexRef>.
-                prim.material = self.material
-                prim.color = self.color
-                prim.normal = self.normal
-                prim.bface = self.bface
-                prim.alpha_mode = self.alpha_mode
-                prim.visibility = self.visibility
-                prim.textures = self.textures
-                prevprev = prev
-                prev = index
-                self.components.append(prim)
+            self.indices = self.expand(array('i', map(int, values)))
+            self.components = {}
             return self # To catch the <Ref>
 
         elif type.upper() == 'COMPONENT':
             index = int(name)
-            return self.components[index]
+            if index < 0 or index >= len(self.indices) // 3:
+                context.warn("Ignoring <Component> {} of primitive with {} triangles".format(index, len(self.indices) // 3))
+                return
+
+            prim = EggPrimitive()
+            # It's fine to copy over the attributes, since the .egg syntax
+            # only allows per-component settings after the <VertexRef>.
+            prim.material = self.material
+            prim.color = self.color
+            prim.normal = self.normal
+            prim.bface = self.bface
+            prim.alpha_mode = self.alpha_mode
+            prim.visibility = self.visibility
+            prim.textures = list(self.textures)
+            self.components[index] = prim
+            return prim
         else:
             EggPrimitive.begin_child(self, context, type, name, values)
 
 
-class EggTriangleFan(EggPrimitive):
+class EggTriangleStrip(EggCompositePrimitive):
 
-    __slots__ = 'components'
+    __slots__ = ()
 
-    def begin_child(self, context, type, name, values):
-        if type.upper() == 'VERTEXREF':
-            indices = [int(v) for v in values]
-            self.indices = tuple(indices)
-            self.components = []
-            first = indices.pop(0)
-            prev = indices.pop(0)
-            while indices:
-                index = indices.pop(0)
-                prim = EggPrimitive()
-                prim.indices = [first, prev, index]
-                # It's fine to copy over the attributes, since the .egg syntax
-                # only allows per-component settings after the <VertexRef>.
-                prim.material = self.material
-                prim.color = self.color
-                prim.normal = self.normal
-                prim.bface = self.bface
-                prim.alpha_mode = self.alpha_mode
-                prim.visibility = self.visibility
-                prim.textures = self.textures
-                prev = index
-                self.components.append(prim)
-            return self # To catch the <Ref>
+    @staticmethod
+    def expand(indices):
+        """ Returns the vertex indices of the triangles making up the strip. """
 
-        elif type.upper() == 'COMPONENT':
-            index = int(name)
-            return self.components[index]
-        else:
-            EggPrimitive.begin_child(self, context, type, name, values)
+        count = len(indices) - 2
+        if count <= 0:
+            return array('i')
+
+        first = indices[:count]
+        second = indices[1:count + 1]
+
+        # Every other triangle is flipped.  I don't think the flipping is
+        # truly necessary for Blender.
+        first[1::2], second[1::2] = second[1::2], first[1::2]
+
+        triangles = array('i', (0,)) * (count * 3)
+        triangles[0::3] = first
+        triangles[1::3] = second
+        triangles[2::3] = indices[2:]
+        return triangles
+
+
+class EggTriangleFan(EggCompositePrimitive):
+
+    __slots__ = ()
+
+    @staticmethod
+    def expand(indices):
+        """ Returns the vertex indices of the triangles making up the fan. """
+
+        count = len(indices) - 2
+        if count <= 0:
+            return array('i')
+
+        triangles = array('i', (0,)) * (count * 3)
+        triangles[0::3] = array('i', indices[:1]) * count
+        triangles[1::3] = indices[1:count + 1]
+        triangles[2::3] = indices[2:]
+        return triangles
 
 
 class EggNode:
@@ -1169,6 +1492,11 @@ class EggGroupNode(EggNode):
         """
         type = type.upper()
 
+        if context.is_excluded(type, name):
+            if type in ('GROUP', 'INSTANCE'):
+                return self.begin_excluded_group(name)
+            return SKIP
+
         if type == 'COORDINATESYSTEM':
             assert len(values) == 1
             context.set_coordinate_system(values[0])
@@ -1201,21 +1529,33 @@ class EggGroupNode(EggNode):
         elif type == 'TRIANGLESTRIP':
             return EggTriangleStrip()
         elif type == 'PATCH':
-            pass
+            return SKIP
         elif type == 'POINTLIGHT':
-            pass
+            return SKIP
         elif type == 'LINE':
-            pass
+            return SKIP
         elif type == 'NURBSSURFACE':
-            pass
+            return SKIP
         elif type == 'NURBSCURVE':
-            pass
+            return SKIP
         elif type == 'TABLE':
             return EggTable(name)
         elif type == 'ANIMPRELOAD':
-            pass
+            return SKIP
+
+    def begin_excluded_group(self, name):
+        """ Returns a group that is left out of the import, but that still
+        reads the vertex pools defined in it and in the groups below it,
+        since other groups may refer to their vertices. """
+
+        group = EggGroup(name, parent=self)
+        group.excluded = True
+        return group
 
     def end_child(self, context, type, name, child):
+        if isinstance(child, EggGroup) and child.excluded:
+            return
+
         if isinstance(child, EggNode):
             self.children.append(child)
 
@@ -1244,18 +1584,42 @@ class EggGroup(EggGroupNode):
         self.instance_type = False
         self.properties = {}
 
-        self.vertices = {}
+        # Maps each vertex pool to an array holding the index of the Blender
+        # vertex for each pool vertex, or -1, and holds the coordinates of the
+        # Blender vertices.
+        self.vertex_maps = {}
+        self.vertex_positions = array('f')
 
         self.matrix = None
         self.default_pose = None
         self.mesh = None
         self.mesh_object = None
+        self.shared_mesh = False
+        # Set on the groups created or emptied by merge_by_material.
+        self.merged = False
         self.first_vertex = 0
-        self.normals = []
+
+        # The primitives are stored in compressed form: the vertex indices of
+        # all faces in one flat array, with the offset at which each face
+        # starts, and per face, an index into a table of distinct primitive
+        # states.  Each state is a (pool, primitive) pair, where the primitive
+        # holds the attributes shared by all the faces with that state.
+        self.prim_indices = array('i')
+        self.prim_offsets = array('i', (0,))
+        self.prim_states = array('i')
+        self.prim_normals = EggVertexColumn('f', (0.0, 0.0, 0.0))
+        self.states = []
+        self.state_ids = {}
+
+        # The loop normals as an (n, 3) float32 array, set by build_mesh.
+        self.normals = None
         self.have_normals = False
-        self.vertex_colors = []
+        # The loop colors as an (n, 4) float32 array, set by build_mesh.
+        self.vertex_colors = None
         self.have_vertex_colors = False
-        self.shape_keys = set()
+        # Maps shape key names to a dictionary of vertex offsets, indexed by
+        # the Blender vertex.
+        self.shape_keys = {}
         self.materials = []
         self.dart = False
         self.external_instance = None
@@ -1263,11 +1627,17 @@ class EggGroup(EggGroupNode):
         self.has_billboard_center = False
         self.empty_display_type = "PLAIN_AXES"
 
+        # Set when the group is excluded from the import by name, or when a
+        # <Collide> entry is found and collision groups are excluded.
+        self.excluded = False
+
         if isinstance(parent, EggGroup):
+            self.level = parent.level + 1
             self.blend_mode = parent.blend_mode
             self.blend_operands = [*parent.blend_operands]
             self.blend_color = [*parent.blend_color]
         else:
+            self.level = 1
             self.blend_mode = None
             self.blend_operands = ["one", "one"]
             self.blend_color = [0, 0, 0, 0]
@@ -1281,27 +1651,401 @@ class EggGroup(EggGroupNode):
 
         return self.instance_type or (self.has_billboard and not self.has_billboard_center)
 
-    def get_bvert(self, vert):
-        # Vertices are keyed by position only, since normals and UVs are
-        # defined per-loop.
-        vertices = self.vertices
-        if vert in vertices:
-            return vertices[vert]
+    def get_content_key(self):
+        """ Returns a hash of everything that goes into the objects built for
+        this group and the groups below it, except for the name and transform
+        of this group itself, or None if they can't be built as instances. """
+
+        content = hashlib.sha1()
+        if self.hash_content(content, root=True):
+            return content.digest()
+        return None
+
+    def hash_content(self, content, root=False):
+        """ Adds the contents of this group to the given hash.  Returns False
+        if the group contains anything that rules out instancing it. """
+
+        if self.dart or self.external_instance:
+            return False
+
+        if not root:
+            matrix = tuple(map(tuple, self.matrix)) if self.matrix else None
+            content.update(repr((self.name, self.instance_type, matrix)).encode('utf-8'))
+
+        attributes = (sorted(self.properties.items()), self.has_billboard, self.has_billboard_center,
+                      self.empty_display_type, self.blend_mode, self.blend_operands, self.blend_color)
+        content.update(repr(attributes).encode('utf-8'))
+
+        if self.prim_states:
+            content.update(bytes(self.prim_offsets))
+            content.update(bytes(self.prim_states))
+            content.update(bytes(self.prim_normals.data))
+            content.update(bytes(self.prim_normals.mask))
+
+            indices = numpy.frombuffer(self.prim_indices, dtype=numpy.int32)
+            offsets = numpy.frombuffer(self.prim_offsets, dtype=numpy.int32)
+            loop_states = numpy.repeat(numpy.frombuffer(self.prim_states, dtype=numpy.int32), numpy.diff(offsets))
+
+            # Hash the attributes of the vertices rather than their indices,
+            # since each instance usually has its own vertex pool.
+            for state, (vpool, prim) in enumerate(self.states):
+                if vpool.dxyzs:
+                    return False
+
+                attributes = (prim.material.name, [texture.name for texture in prim.textures],
+                              prim.color, prim.bface, prim.alpha_mode, sorted(vpool.uvs))
+                content.update(repr(attributes).encode('utf-8'))
+
+                state_indices = indices[loop_states == state]
+                columns = [vpool.positions, vpool.normals, vpool.colors]
+                columns += [column for name, column in sorted(vpool.uvs.items())]
+                for column in columns:
+                    values, mask = column.take(state_indices)
+                    content.update(values.tobytes())
+                    content.update(mask.tobytes())
+
+        content.update(b'(')
+        for child in self.children:
+            if not isinstance(child, EggGroup) or not child.hash_content(content):
+                return False
+        content.update(b')')
+        return True
+
+    def build_collection_instance(self, context, parent, key):
+        """ Creates an object instancing the collection that holds the contents
+        of this group.  The first group with these contents builds them into
+        a new collection, which isn't linked into the scene. """
+
+        source = None
+        collection = context.instance_collections.get(key)
+        if collection is None:
+            collection = bpy.data.collections.new(self.name)
+            context.instance_collections[key] = collection
+
+            # Build the contents in the coordinate space of the instance.
+            del context.repeated_instances[self]
+            matrix = self.matrix
+            self.matrix = None
+            new_objects = context.new_objects
+            context.new_objects = []
+            source = self.build_tree(context, None)
+
+            for object, select in context.new_objects:
+                collection.objects.link(object)
+            context.new_objects = new_objects
+            self.matrix = matrix
+        else:
+            # The contents of this group won't be built, so remove the meshes
+            # that were created for them while reading the file.
+            self.remove_meshes()
+
+        object = bpy.data.objects.new(self.name, None)
+        if source is not None and object.name != self.name and source.name == self.name:
+            # Give the name to the instancing object rather than the source.
+            name = object.name
+            source.name = self.name + "~"
+            object.name = self.name
+            source.name = name
+
+        object.instance_type = 'COLLECTION'
+        object.instance_collection = collection
+        object.parent = parent
+        if self.matrix:
+            object.matrix_basis = context.transform_matrix(self.matrix)
 
-        mesh = self.mesh
-        index = len(mesh.vertices)
-        mesh.vertices.add(1)
-        bvert = mesh.vertices[index]
-        bvert.co = vert.pos
-        vertices[vert] = index
+        context.new_objects.append((object, True))
+        self.object = object
+        return object
+
+    def is_static(self):
+        """ Returns true if nothing other than its transform and geometry
+        requires this group to be kept as an object of its own: it has no
+        properties or tags, and isn't a character, billboard, instance or
+        DCS node. """
+
+        return not self.properties and not self.dart and \
+               not self.has_billboard and not self.has_billboard_center and \
+               not self.instance_type and not self.external_instance and \
+               self.empty_display_type == "PLAIN_AXES"
+
+    def is_pass_through(self):
+        """ Returns true if this group has no geometry, transform, properties
+        or other attributes of its own, so that its children might as well
+        be attached to its parent instead. """
+
+        return not self.mesh and not self.matrix and self.is_static()
+
+    def can_merge(self):
+        """ Returns true if the geometry of this group may be merged with that
+        of other groups, by merge_by_material. """
+
+        return not self.merged and self.is_static() and \
+               not any(vpool.dxyzs for vpool, prim in self.states)
+
+    def merge_by_material(self, context):
+        """ Moves the geometry of this group and of all the groups below it
+        that can be merged into new child groups, one for each distinct
+        material, or keeps it in this group if there is only one.  The groups
+        that can't be merged are attached to this one directly, with the
+        transforms of the groups in between applied to their own.  The
+        geometry can be moved as is, since the vertices are specified in
+        global space. """
+
+        buckets = {}
+        children = []
+        self.merged = True
+        self.move_faces_by_material(buckets, self)
+
+        # Walk the tree below, with the composed transform of the groups that
+        # are being merged away.
+        stack = [(child, None) for child in reversed(self.children)]
+        while stack:
+            child, matrix = stack.pop()
+            if isinstance(child, EggGroup) and child.can_merge():
+                if child.matrix:
+                    matrix = matmul(matrix, child.matrix) if matrix else child.matrix
+                child.move_faces_by_material(buckets, self)
+                stack.extend((grandchild, matrix) for grandchild in reversed(child.children))
+            else:
+                if matrix and isinstance(child, EggGroup):
+                    child.matrix = matmul(matrix, child.matrix) if child.matrix else matrix.copy()
+                children.append(child)
+
+        # The meshes are only created now, so that none are left behind for
+        # buckets that ended up empty.
+        buckets = [bucket for bucket in buckets.values() if bucket.prim_states]
+        if len(buckets) == 1:
+            # A single material doesn't need a child object of its own.
+            bucket, = buckets
+            self.prim_indices = bucket.prim_indices
+            self.prim_offsets = bucket.prim_offsets
+            self.prim_states = bucket.prim_states
+            self.prim_normals = bucket.prim_normals
+            self.states = bucket.states
+            self.state_ids = bucket.state_ids
+            self.blend_mode = bucket.blend_mode
+            self.blend_operands = bucket.blend_operands
+            self.blend_color = bucket.blend_color
+            for vpool, prim in self.states:
+                vpool.groups.discard(bucket)
+                vpool.groups.add(self)
+            buckets = [self]
+        else:
+            children += buckets
+
+        for bucket in buckets:
+            bucket.mesh = bpy.data.meshes.new(bucket.name)
+            bucket.mesh.use_fake_user = True
 
-        self.shape_keys.update(vert.dxyzs.keys())
-        return index
+        self.children = children
+
+    def move_faces_by_material(self, buckets, root):
+        """ Moves the faces of this group into the groups in the given
+        dictionary, which is indexed by the attributes that determine the
+        material, adding groups under the given root group as needed. """
+
+        self.remove_mesh()
+
+        if not self.prim_states:
+            return
+
+        face_states = numpy.frombuffer(self.prim_states, dtype=numpy.int32)
+        for state, (vpool, prim) in enumerate(self.states):
+            # These are the attributes that EggMaterial.get_material uses to
+            # tell materials apart.
+            key = (prim.material, tuple(prim.textures), prim.color, prim.bface, prim.alpha_mode,
+                   self.blend_mode, self.blend_operands[0], self.blend_operands[1])
+            target = buckets.get(key)
+            if target is None:
+                target = EggGroup("{}_{}".format(root.name, len(buckets)), parent=root)
+                target.blend_mode = self.blend_mode
+                target.blend_operands = [*self.blend_operands]
+                target.blend_color = [*self.blend_color]
+                target.merged = True
+                buckets[key] = target
+
+            faces = numpy.flatnonzero(face_states == state)
+            if len(faces):
+                target.add_faces(self, faces, vpool, prim)
+
+        self.prim_indices = array('i')
+        self.prim_offsets = array('i', (0,))
+        self.prim_states = array('i')
+        self.states = []
+        self.state_ids = {}
+
+    def remove_mesh(self):
+        """ Removes the mesh of this group, if its geometry is not going to be
+        built into it after all. """
+
+        if self.mesh is not None:
+            for vpool, prim in self.states:
+                vpool.groups.discard(self)
+            bpy.data.meshes.remove(self.mesh)
+            self.mesh = None
+
+    def remove_meshes(self):
+        """ Removes the meshes of this group and of all the groups below it. """
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, EggGroup):
+                node.remove_mesh()
+            if isinstance(node, EggGroupNode):
+                stack.extend(node.children)
+
+    def add_faces(self, group, faces, vpool, prim):
+        """ Appends the given faces of another group's primitive buffer to
+        this one's, with the attributes of the given primitive. """
+
+        offsets = numpy.frombuffer(group.prim_offsets, dtype=numpy.int32)
+        counts = numpy.diff(offsets)
+        selected = numpy.zeros(len(counts), dtype=bool)
+        selected[faces] = True
+        indices = numpy.frombuffer(group.prim_indices, dtype=numpy.int32)
+
+        first = len(self.prim_states)
+        self.prim_indices.frombytes(indices[numpy.repeat(selected, counts)].tobytes())
+        self.prim_offsets.extend((numpy.cumsum(counts[faces]) + self.prim_offsets[-1]).tolist())
+        self.prim_states.extend(array('i', (self.get_state(prim, vpool),)) * len(faces))
+
+        for i, face in enumerate(faces.tolist()):
+            normal = group.prim_normals.get(face)
+            if normal is not None:
+                self.prim_normals.set(first + i, normal)
+
+        vpool.groups.add(self)
+
+    def get_vertex_map(self, vpool):
+        """ Returns an array giving the index of the Blender vertex for each
+        vertex in the pool, or -1 if the vertex isn't used by this group. """
+
+        vertex_map = self.vertex_maps.get(vpool)
+        if vertex_map is None:
+            vertex_map = numpy.full(len(vpool), -1, dtype=numpy.int32)
+        return vertex_map
+
+    def assign_vertices(self, context, matrix=None):
+        """ Assigns a Blender vertex to each distinct pool vertex used by the
+        faces, in order of first use, and returns the Blender vertex of each
+        loop.  Vertices are identified by their pool and index only; merging
+        vertices by position is done in a separate pass, if enabled.  The
+        positions are transformed by the given matrix, if any. """
+
+        if not self.prim_indices:
+            self.vertex_positions = array('f')
+            return numpy.empty(0, dtype=numpy.int32)
+
+        pool_ids = {}
+        state_pools = numpy.array([pool_ids.setdefault(vpool, len(pool_ids))
+                                   for vpool, prim in self.states], dtype=numpy.int64)
+
+        indices = numpy.frombuffer(self.prim_indices, dtype=numpy.int32)
+        offsets = numpy.frombuffer(self.prim_offsets, dtype=numpy.int32)
+        face_states = numpy.frombuffer(self.prim_states, dtype=numpy.int32)
+
+        # Combine the pool and the index into one key per loop.
+        loop_pools = numpy.repeat(state_pools[face_states], numpy.diff(offsets))
+        keys = (loop_pools << 32) | indices
+        keys, first, loop_vertices = numpy.unique(keys, return_index=True, return_inverse=True)
+
+        # Number the vertices in order of first use, not in key order.
+        order = numpy.argsort(first)
+        rank = numpy.empty(len(order), dtype=numpy.int32)
+        rank[order] = numpy.arange(len(order), dtype=numpy.int32)
+        loop_vertices = rank[loop_vertices]
+        keys = keys[order]
+        vertex_pools = keys >> 32
+        vertex_indices = keys & 0xffffffff
+
+        positions = numpy.empty((len(keys), 3))
+        self.vertex_maps = {}
+        for vpool, pool_id in pool_ids.items():
+            bverts = numpy.flatnonzero(vertex_pools == pool_id)
+            pool_indices = vertex_indices[bverts]
+            pool_positions = numpy.frombuffer(vpool.positions.data, dtype=numpy.float64).reshape(-1, 3)
+            positions[bverts] = pool_positions[pool_indices]
+
+            vertex_map = numpy.full(len(vpool), -1, dtype=numpy.int32)
+            vertex_map[pool_indices] = bverts
+            self.vertex_maps[vpool] = vertex_map
+
+        if context.weld_vertices:
+            positions, loop_vertices = self.weld_vertices(positions, loop_vertices, context.weld_distance)
+
+        if matrix is not None:
+            matrix = numpy.array(matrix)
+            positions = numpy.dot(positions, matrix[:3, :3].T) + matrix[:3, 3]
+
+        self.vertex_positions = positions.astype(numpy.float32).ravel()
+
+        # Record the morph offsets of the vertices that have them.
+        for vpool, vertex_map in self.vertex_maps.items():
+            if not vpool.dxyzs:
+                continue
+            vertex_map = vertex_map.tolist()
+            for name, dxyzs in vpool.dxyzs.items():
+                for vindex, dxyz in dxyzs.items():
+                    if 0 <= vindex < len(vertex_map) and vertex_map[vindex] >= 0:
+                        self.shape_keys.setdefault(name, {}).setdefault(vertex_map[vindex], dxyz)
+
+        return loop_vertices
+
+    def weld_vertices(self, positions, loop_vertices, distance):
+        """ Merges the vertices that share a position, or with a nonzero
+        distance, that fall in the same cell of a grid of that size.  Returns
+        the remaining positions and the remapped loop vertices. """
+
+        if distance > 0:
+            cells = numpy.floor(positions / distance + 0.5)
+        else:
+            # Adding zero turns -0.0 into 0.0, so that they compare equal.
+            cells = positions + 0.0
+
+        # View each row as a single opaque value, so that rows can be compared
+        # with a one-dimensional unique().
+        cells = numpy.ascontiguousarray(cells)
+        cells = cells.view(numpy.dtype((numpy.void, cells.dtype.itemsize * 3))).ravel()
+        cells, first, remap = numpy.unique(cells, return_index=True, return_inverse=True)
+        if len(cells) == len(positions):
+            return positions, loop_vertices
+
+        # Keep the first vertex of each cell, in order of first use.
+        order = numpy.argsort(first)
+        rank = numpy.empty(len(order), dtype=numpy.int32)
+        rank[order] = numpy.arange(len(order), dtype=numpy.int32)
+        remap = rank[remap.ravel()]
+
+        for vertex_map in self.vertex_maps.values():
+            used = vertex_map >= 0
+            vertex_map[used] = remap[vertex_map[used]]
+
+        return positions[first[order]], remap[loop_vertices]
 
     def begin_child(self, context, type, name, values):
         orig_type = type
         type = type.upper()
 
+        if self.excluded:
+            # Vertex pools are still needed, since other groups may refer to
+            # the vertices defined in them, including in nested groups.
+            if type in ('GROUP', 'INSTANCE', 'JOINT'):
+                return self.begin_excluded_group(name)
+            elif type != 'VERTEXPOOL':
+                return SKIP
+
+        elif context.is_excluded(type, name):
+            if type == 'COLLIDE':
+                # Leave out the entire collision group, including the groups
+                # below it that have already been read.
+                self.excluded = True
+                self.remove_meshes()
+                self.children = []
+            elif type in ('GROUP', 'INSTANCE'):
+                return EggGroupNode.begin_child(self, context, type, name, values)
+            return SKIP
+
         #if type in ('SCALAR', 'CHAR*', 'BILLBOARD', 'DCS', 'DART', 'SWITCH', 'OBJECTTYPE', 'TAG', 'MODEL', 'TEXLIST', 'REF'):
 
         if type in ('SCALAR', 'CHAR*'):
@@ -1350,7 +2094,7 @@ class EggGroup(EggGroupNode):
             return EggTransform()
 
         elif type == 'VERTEXREF':
-            vertex_ref = EggGroupVertexRef([int(v) for v in values])
+            vertex_ref = EggGroupVertexRef(array('i', map(int, values)))
             context.group_vertex_refs.append((self.name, vertex_ref))
             return vertex_ref
 
@@ -1397,7 +2141,11 @@ class EggGroup(EggGroupNode):
             self.any_geometry_below = True
 
             if child.pool:
-                vpool = context.vertex_pools[child.pool]
+                vpool = context.vertex_pools.get(child.pool)
+                if vpool is None:
+                    context.warn("Ignoring primitive referencing unknown pool {}".format(child.pool))
+                    return
+
                 vpool.groups.add(self)
 
                 if self.mesh is None:
@@ -1415,11 +2163,10 @@ class EggGroup(EggGroupNode):
                             bpy.data.meshes.remove(other)
                             self.mesh.name = self.name
 
-                if hasattr(child, 'components'):
-                    for component in child.components:
-                        self.add_polygon(context, component, vpool)
+                if isinstance(child, EggCompositePrimitive):
+                    self.add_triangles(context, child, vpool)
                 else:
-                    self.add_polygon(context, child, vpool)
+                    self.add_primitive(context, child, vpool)
             else:
                 context.warn("Ignoring primitive without pool reference")
 
@@ -1438,87 +2185,368 @@ class EggGroup(EggGroupNode):
 
         return EggGroupNode.end_child(self, context, type, name, child)
 
-    def add_polygon(self, context, prim, vpool):
+    def add_primitive(self, context, prim, vpool):
+        """ Appends the primitive to the group's compressed primitive buffer.
+        The faces are only created in Blender by build_tree. """
+
+        index = vpool.find_undefined(prim.indices)
+        if index is not None:
+            context.error("Primitive references index {}, which is not defined in vertex pool '{}'".format(index, vpool.name))
+            return
+
         if prim.normal:
-            self.have_normals = True
-        poly_normal = prim.normal or (0, 0, 0)
+            self.prim_normals.set(len(self.prim_states), prim.normal)
 
-        # Create a polygon.
-        mesh = self.mesh
-        poly_index = len(mesh.polygons)
-        mesh.polygons.add(1)
-        poly = mesh.polygons[poly_index]
-
-        # Create the loops.  A loop is an occurrence of a vertex in a polygon.
-        loops = mesh.loops
-        loop_offset = len(loops)
-        loops.add(len(prim.indices))
-        for index, loop in zip(prim.indices, loops[loop_offset:]):
-            try:
-                vertex = vpool[index]
-            except IndexError:
-                context.error("Primitive references index {}, which is not defined in vertex pool '{}'".format(index, vpool.name))
-                # Skip the face.  This will leave some unused loops, but
-                # they will be cleaned up by validate().
-                return
+        self.prim_indices.extend(prim.indices)
+        self.prim_offsets.append(len(self.prim_indices))
+        self.prim_states.append(self.get_state(prim, vpool))
 
-            loop.vertex_index = self.get_bvert(vertex)
+    def add_triangles(self, context, prim, vpool):
+        """ Appends the triangles of a strip or fan to the primitive buffer.
+        They all share the state of the primitive, except for the triangles
+        that have their own <Component> attributes. """
 
-            vertex_normal = vertex.normal
-            if vertex_normal:
-                self.have_normals = True
-                self.normals.append(vertex_normal or poly_normal)
-                poly.use_smooth = True
-            else:
-                self.normals.append(vertex_normal or poly_normal)
+        indices = prim.indices
+        index = vpool.find_undefined(indices)
+        if index is not None:
+            context.error("Primitive references index {}, which is not defined in vertex pool '{}'".format(index, vpool.name))
+            return
 
-            if bpy.app.version >= (2, 79, 7):
-                if vertex.color:
-                    self.have_vertex_colors = True
-                    self.vertex_colors += vertex.color
-                else:
-                    self.vertex_colors += (1, 1, 1, 1)
-            else:
-                if vertex.color:
-                    self.have_vertex_colors = True
-                    self.vertex_colors += vertex.color[:3]
+        count = len(indices) // 3
+        first = len(self.prim_states)
+        start = len(self.prim_indices)
+        self.prim_indices.extend(indices)
+        self.prim_offsets.extend(range(start + 3, start + count * 3 + 1, 3))
+        self.prim_states.extend(array('i', (self.get_state(prim, vpool),)) * count)
+
+        if prim.normal:
+            for face in range(first, first + count):
+                self.prim_normals.set(face, prim.normal)
+
+        for index, component in prim.components.items():
+            self.prim_states[first + index] = self.get_state(component, vpool)
+            if component.normal:
+                self.prim_normals.set(first + index, component.normal)
+
+    def get_state(self, prim, vpool):
+        """ Returns the index of the state shared by all primitives with the
+        same attributes as the given one, adding it if it is new. """
+
+        key = (vpool, prim.material, tuple(prim.textures), prim.color, prim.bface, prim.alpha_mode)
+        state = self.state_ids.get(key)
+        if state is None:
+            state = len(self.states)
+            self.state_ids[key] = state
+            self.states.append((vpool, prim))
+        return state
+
+    def remove_invalid_faces(self, context, loop_vertices):
+        """ Finds the faces that use a vertex more than once or that have fewer
+        than three vertices, and the faces that use the same set of vertices
+        as an earlier face, and removes them from the primitive buffer.
+        Returns the loop vertices of the remaining faces, and the number of
+        faces that were removed. """
+
+        offsets = numpy.frombuffer(self.prim_offsets, dtype=numpy.int32)
+        counts = numpy.diff(offsets)
+        num_faces = len(counts)
+        if not num_faces:
+            return loop_vertices, 0
+
+        # Sort the vertices within each face, which puts repeated vertices
+        # next to each other and gives each face a unique signature.
+        loop_faces = numpy.repeat(numpy.arange(num_faces, dtype=numpy.int32), counts)
+        sorted_vertices = loop_vertices[numpy.lexsort((loop_vertices, loop_faces))]
+        repeated = (loop_faces[1:] == loop_faces[:-1]) & (sorted_vertices[1:] == sorted_vertices[:-1])
+
+        invalid = counts < 3
+        invalid[loop_faces[1:][repeated]] = True
+        num_degenerate = numpy.count_nonzero(invalid)
+
+        # Compare the signatures of the remaining faces with the same number
+        # of vertices, and keep only the first face with each signature.
+        num_duplicate = 0
+        for count in numpy.unique(counts[~invalid]):
+            faces = numpy.flatnonzero((counts == count) & ~invalid)
+            signatures = sorted_vertices[offsets[faces, None] + numpy.arange(count)]
+            signatures = numpy.ascontiguousarray(signatures)
+            signatures = signatures.view(numpy.dtype((numpy.void, signatures.dtype.itemsize * count))).ravel()
+            unique, first = numpy.unique(signatures, return_index=True)
+            if len(unique) < len(faces):
+                duplicate = numpy.ones(len(faces), dtype=bool)
+                duplicate[first] = False
+                invalid[faces[duplicate]] = True
+                num_duplicate += len(faces) - len(unique)
+
+        context.degenerate_faces += num_degenerate
+        context.duplicate_faces += num_duplicate
+        if not num_degenerate and not num_duplicate:
+            return loop_vertices, 0
+
+        # Compact the primitive buffer.
+        keep = ~invalid
+        keep_loops = numpy.repeat(keep, counts)
+        indices = numpy.frombuffer(self.prim_indices, dtype=numpy.int32)
+        face_states = numpy.frombuffer(self.prim_states, dtype=numpy.int32)
+        self.prim_indices = array('i', indices[keep_loops].tobytes())
+        self.prim_states = array('i', face_states[keep].tobytes())
+        self.prim_offsets = array('i', (0,))
+        self.prim_offsets.extend(numpy.cumsum(counts[keep]).tolist())
+
+        face_normals = self.prim_normals
+        if len(face_normals):
+            face_normals.resize(num_faces)
+            normals = numpy.frombuffer(face_normals.data, dtype=numpy.float32).reshape(-1, 3)
+            mask = numpy.frombuffer(bytes(face_normals.mask), dtype=numpy.uint8)
+            face_normals.data = array('f', normals[keep].tobytes())
+            face_normals.mask = bytearray(mask[keep].tobytes())
+
+        return loop_vertices[keep_loops], num_degenerate + num_duplicate
+
+    def build_mesh(self, context, matrix=None):
+        """ Creates the faces stored in the primitive buffer.  The geometry is
+        gathered into flat arrays first, so that each collection of the mesh
+        is only resized once and each attribute is set with one foreach_set.
+        The positions and normals are transformed by the given matrix first.
+        Returns true if the mesh may still contain geometry that needs to be
+        corrected by Mesh.validate(). """
+
+        loop_vertices = self.assign_vertices(context, matrix)
+        loop_vertices, num_removed = self.remove_invalid_faces(context, loop_vertices)
+        num_vertices = len(self.vertex_positions) // 3
+
+        mesh = self.mesh
+        indices = self.prim_indices
+        offsets = self.prim_offsets
+        face_states = self.prim_states
+        states = self.states
+        num_faces = len(face_states)
+        num_loops = len(indices)
+
+        # The face of each loop, and the loops of each vertex pool, so that
+        # the vertex attributes can be gathered one pool at a time.
+        face_lengths = numpy.diff(numpy.frombuffer(offsets, dtype=numpy.int32))
+        loop_faces = numpy.repeat(numpy.arange(num_faces, dtype=numpy.int32), face_lengths)
+        loop_indices = numpy.frombuffer(indices, dtype=numpy.int32)
+        pool_states = {}
+        for state, (vpool, prim) in enumerate(states):
+            pool_states.setdefault(vpool, []).append(state)
+
+        pool_loops = {}
+        if len(pool_states) == 1:
+            for vpool in pool_states:
+                pool_loops[vpool] = numpy.arange(num_loops)
+        else:
+            loop_states = numpy.frombuffer(face_states, dtype=numpy.int32)[loop_faces]
+            for vpool, pool_state_ids in pool_states.items():
+                pool_loops[vpool] = numpy.flatnonzero(numpy.isin(loop_states, pool_state_ids))
+
+        # The normal of each loop, taken from the vertex or otherwise from the
+        # polygon.  Faces with vertex normals are shaded smooth.
+        normals, normal_mask = self.prim_normals.take(loop_faces)
+        vertex_normal_mask = numpy.zeros(num_loops, dtype=bool)
+        for vpool, loops in pool_loops.items():
+            values, mask = vpool.normals.take(loop_indices[loops])
+            mask = mask.view(bool)
+            normals[loops[mask]] = values[mask]
+            vertex_normal_mask[loops[mask]] = True
+
+        self.have_normals = bool(normal_mask.any() or vertex_normal_mask.any())
+
+        smooth_faces = numpy.zeros(num_faces, dtype=numpy.uint8)
+        smooth_faces[loop_faces[vertex_normal_mask]] = 1
+
+        # The color of each loop, as four floats, white if not specified.
+        colors = numpy.ones((num_loops, 4), dtype=numpy.float32)
+        for vpool, loops in pool_loops.items():
+            values, mask = vpool.colors.take(loop_indices[loops])
+            if mask.any():
+                self.have_vertex_colors = True
+                colors[loops] = values
+        self.vertex_colors = colors
+
+        # One buffer of coordinates per UV set.  Loops whose vertex has no
+        # coordinates for that set are left at zero.
+        uv_buffers = {}
+        for vpool, loops in pool_loops.items():
+            for name, column in vpool.uvs.items():
+                values, mask = column.take(loop_indices[loops])
+                mask = mask.view(bool)
+                if not mask.any():
+                    continue
+
+                buffer = uv_buffers.get(name)
+                if buffer is None:
+                    buffer = numpy.zeros((num_loops, 2), dtype=numpy.float32)
+                    uv_buffers[name] = buffer
+                buffer[loops[mask]] = values[mask]
+
+        if self.have_normals and matrix is not None:
+            normal_matrix = numpy.array(matrix.to_3x3().inverted().transposed())
+            normals = numpy.dot(normals, normal_matrix.T)
+            lengths = numpy.sqrt(numpy.einsum('ij,ij->i', normals, normals))
+            lengths[lengths == 0] = 1
+            normals /= lengths[:, None]
+            normals = normals.astype(numpy.float32)
+        self.normals = normals
+
+        # Don't bother with a color layer if all the vertex colors are white,
+        # unless they are needed to override the color of some polygons.
+        if self.have_vertex_colors and (colors == 1.0).all():
+            if all(prim.color is None or tuple(prim.color) == (1, 1, 1, 1) for vpool, prim in states):
+                self.have_vertex_colors = False
+
+        # Look up the material for each state, and of each face.
+        state_materials = array('i')
+        for vpool, prim in states:
+            state_materials.append(self.get_material_index(prim))
+        face_materials = array('i', map(state_materials.__getitem__, face_states))
+
+        # If an earlier group has the same geometry, use its mesh instead.
+        # Meshes with shape keys or vertex groups are not shared, since those
+        # are added to the mesh later on.
+        if context.share_meshes and not self.shape_keys and \
+           not any(context.is_weighted_pool(vpool) for vpool in self.vertex_maps):
+            content = hashlib.sha1()
+            for buffer in (self.vertex_positions, loop_vertices, offsets, smooth_faces, face_materials):
+                content.update(bytes(buffer))
+                content.update(b'\0')
+            if self.have_normals:
+                content.update(b'normals')
+                content.update(bytes(normals))
+            if self.have_vertex_colors:
+                content.update(b'colors')
+                content.update(bytes(colors))
+            for name, buffer in sorted(uv_buffers.items()):
+                content.update(name.encode('utf-8'))
+                content.update(bytes(buffer))
+            for bmat in self.materials:
+                content.update(b'\0' + bmat.name.encode('utf-8'))
+            if bpy.app.version < (2, 80):
+                content.update(bytes(face_states))
+                for vpool, prim in states:
+                    content.update(b'\1')
+                    for texture in prim.textures:
+                        content.update(b'\0' + texture.texture.name.encode('utf-8'))
+
+            key = content.digest()
+            shared = context.shared_meshes.get(key)
+            if shared is not None:
+                bpy.data.meshes.remove(mesh)
+                self.mesh = shared
+                self.shared_mesh = True
+                return False
+
+            context.shared_meshes[key] = mesh
+
+        # Create the UV layers before adding any loops, so that they start
+        # out zeroed rather than initialized from the active layer.
+        for name in uv_buffers:
+            if name not in mesh.uv_layers:
+                if bpy.app.version >= (2, 80):
+                    mesh.uv_layers.new(name=name)
                 else:
-                    self.vertex_colors += (1, 1, 1)
+                    mesh.uv_textures.new(name)
 
-            for name, uv in vertex.uv_map.items():
-                if name not in mesh.uv_layers:
-                    if bpy.app.version >= (2, 80):
-                        mesh.uv_layers.new(name=name)
-                    else:
-                        mesh.uv_textures.new(name)
-                mesh.uv_layers[name].data[loop.index].uv = uv
+        # A loop is an occurrence of a vertex in a polygon.
+        mesh.vertices.add(num_vertices)
+        mesh.loops.add(num_loops)
+        mesh.polygons.add(num_faces)
 
-        # Reference those loops in the polygon.
-        poly.loop_start = loop_offset
+        mesh.vertices.foreach_set('co', self.vertex_positions)
+        mesh.loops.foreach_set('vertex_index', loop_vertices)
+        mesh.polygons.foreach_set('loop_start', offsets[:-1])
         # Newer versions of Blender have changed loop_total to be readonly, resulting in a crash.
         if bpy.app.version < (3, 6):
-            poly.loop_total = len(prim.indices)
+            mesh.polygons.foreach_set('loop_total', array('i', [end - start for start, end in zip(offsets, offsets[1:])]))
+
+        if smooth_faces.any():
+            # Faces without vertex normals keep the default shading.
+            use_smooth = numpy.zeros(num_faces, dtype=numpy.int32)
+            mesh.polygons.foreach_get('use_smooth', use_smooth)
+            use_smooth |= smooth_faces
+            mesh.polygons.foreach_set('use_smooth', use_smooth)
+
+        for name, buffer in uv_buffers.items():
+            mesh.uv_layers[name].data.foreach_set('uv', buffer.ravel())
 
         # Assign the highest priority texture that uses a given UV set to
         # the UV texture.  If there are multiple textures with the same
         # priority, use the first one.
         if bpy.app.version < (2, 80):
-            set_textures = {}
-            for texture in prim.textures:
-                uv_name = texture.uv_name or DEFAULT_UV_NAME
-                try:
-                    uv_texture = mesh.uv_textures[uv_name]
-                except KeyError:
-                    # Display a warning.  Since this will probably be the case
-                    # for every polygon in this mesh, display it only once.
-                    if vpool.name not in texture.warned_vpools:
-                        texture.warned_vpools.add(vpool.name)
-                        context.warn("Texture {} references UV set {} which is not present on any vertex in {}".format(texture.texture.name, texture.uv_name, self.name))
-                    continue
+            for face, state in enumerate(face_states):
+                vpool, prim = states[state]
+                set_textures = {}
+                for texture in prim.textures:
+                    uv_name = texture.uv_name or DEFAULT_UV_NAME
+                    try:
+                        uv_texture = mesh.uv_textures[uv_name]
+                    except KeyError:
+                        # Display a warning.  Since this will probably be the case
+                        # for every polygon in this mesh, display it only once.
+                        if vpool.name not in texture.warned_vpools:
+                            texture.warned_vpools.add(vpool.name)
+                            context.warn("Texture {} references UV set {} which is not present on any vertex in {}".format(texture.texture.name, texture.uv_name, self.name))
+                        continue
+
+                    if uv_name not in set_textures or texture.priority > set_textures[uv_name].priority:
+                        set_textures[uv_name] = texture
+                        uv_texture.data[face].image = texture.texture.image
+
+        if self.materials:
+            mesh.polygons.foreach_set('material_index', face_materials)
+
+        # Degenerate and duplicate faces have already been removed; check for
+        # the other problems that validate() corrects, which can only come
+        # from malformed input.
+        if num_loops and (loop_vertices.min() < 0 or loop_vertices.max() >= num_vertices):
+            return True
+        if num_faces and face_lengths.min() < 3:
+            return True
+        if not numpy.isfinite(self.vertex_positions).all():
+            return True
+        if self.have_normals and not numpy.isfinite(normals).all():
+            return True
+        return False
+
+    def build_vertex_colors(self, context):
+        """ Creates the color layer of the mesh from the loop colors. """
+
+        data = self.mesh
+        colors = self.vertex_colors
+
+        if bpy.app.version < (3, 4):
+            cols = data.vertex_colors.new()
+            if bpy.app.version < (2, 79, 7):
+                colors = colors[:, :3]
+            cols.data.foreach_set('color', colors.ravel())
+            return
+
+        # Store the colors per vertex if every loop of a vertex has the same
+        # color, and use 8 bits per channel unless they exceed [0, 1].
+        loop_vertices = numpy.empty(len(data.loops), dtype=numpy.int32)
+        data.loops.foreach_get('vertex_index', loop_vertices)
+        point_colors = numpy.ones((len(data.vertices), 4), dtype=numpy.float32)
+        point_colors[loop_vertices] = colors
 
-                if uv_name not in set_textures or texture.priority > set_textures[uv_name].priority:
-                    set_textures[uv_name] = texture
-                    uv_texture.data[poly_index].image = texture.texture.image
+        if numpy.array_equal(point_colors[loop_vertices], colors):
+            domain = 'POINT'
+            colors = point_colors
+        else:
+            domain = 'CORNER'
+
+        if colors.size and (colors.min() < 0.0 or colors.max() > 1.0):
+            type = 'FLOAT_COLOR'
+        else:
+            type = 'BYTE_COLOR'
+
+        attribute = data.color_attributes.new("Col", type, domain)
+        attribute.data.foreach_set('color_srgb', colors.ravel())
+        data.color_attributes.active_color = attribute
+
+    def get_material_index(self, prim):
+        """ Returns the index of the material to use for the given primitive,
+        adding it to the mesh if necessary. """
 
         # Check if we already have a material for this combination.
         bmat = prim.material.get_material(self, prim)
@@ -1538,25 +2566,60 @@ class EggGroup(EggGroupNode):
             bmat = None
 
         if not bmat:
-            return
+            return 0
 
         if bmat in self.materials:
-            index = self.materials.index(bmat)
-        else:
-            index = len(self.materials)
-            self.materials.append(bmat)
-            mesh.materials.append(bmat)
-        poly.material_index = index
+            return self.materials.index(bmat)
+
+        self.materials.append(bmat)
+        self.mesh.materials.append(bmat)
+        return len(self.materials) - 1
 
     def build_tree(self, context, parent, inv_matrix=None, under_dart=False):
         """ Walks the hierarchy of groups and builds the Blender object graph.
         This needs to happen after adding all the children so that we fully
         know the parent-child hierarchy and transforms. """
 
+        key = context.repeated_instances.get(self)
+        if key is not None:
+            return self.build_collection_instance(context, parent, key)
+
+        # Merge before flattening, so that a pass-through group at the merge
+        # level still collects the geometry below it.
+        if context.merge_by_material and not under_dart and \
+           self.level == context.merge_level and self.can_merge():
+            self.merge_by_material(context)
+
+        if context.flatten_groups and self.is_pass_through():
+            # Without a transform of its own, the children keep their place
+            # when attached directly to the parent.
+            for child in self.children:
+                child.build_tree(context, parent, inv_matrix, under_dart)
+            return None
+
+        if not inv_matrix:
+            inv_matrix = context.inv_cs_matrix
+
+        if self.matrix:
+            inv_matrix = matmul(context.transform_matrix(self.matrix).inverted(), inv_matrix)
+
+        if self.is_instance_type():
+            inv_matrix = context.inv_cs_matrix
+
         data = None
         self.mesh_object = None
         if self.mesh:
+            # The .egg format specifies vertex data in global space, so we have
+            # to transform the vertices by the inverse matrix to compensate for
+            # that.  A character keeps its geometry as is.
+            if self.dart and not under_dart:
+                corrected = self.build_mesh(context)
+            else:
+                corrected = self.build_mesh(context, inv_matrix)
             data = self.mesh
+
+        # A mesh shared with an earlier group has already been finished.
+        if data and not self.shared_mesh:
             if bpy.app.version >= (2, 81):
                 data.update(calc_edges=True)
             elif bpy.app.version >= (2, 80):
@@ -1570,22 +2633,36 @@ class EggGroup(EggGroupNode):
                 # https://projects.blender.org/blender/blender/commit/ab5fc46872b9960b5bb50d98147bea0d677028b9
                 if hasattr(data, "calc_normals"):
                     data.calc_normals()
-                max_diff = 0
-                for normal1, l in zip(self.normals, data.loops):
-                    normal2 = data.vertices[l.vertex_index].normal
-                    diff = (normal2 - Vector(normal1)).length_squared
-                    max_diff = max(diff, max_diff)
+
+                vertex_normals = numpy.empty(len(data.vertices) * 3, dtype=numpy.float32)
+                data.vertices.foreach_get('normal', vertex_normals)
+                loop_vertices = numpy.empty(len(data.loops), dtype=numpy.int32)
+                data.loops.foreach_get('vertex_index', loop_vertices)
+
+                normals = self.normals
+                diff = vertex_normals.reshape(-1, 3)[loop_vertices] - normals
+                max_diff = numpy.einsum('ij,ij->i', diff, diff).max() if len(diff) else 0
 
                 if max_diff > 0.01:
-                    data.normals_split_custom_set(self.normals)
+                    # The setters take a sequence of rows rather than a flat
+                    # buffer, and convert it one row at a time.  If all loops
+                    # of each vertex share a normal, pass one row per vertex.
+                    point_normals = numpy.zeros((len(data.vertices), 3), dtype=numpy.float32)
+                    point_normals[loop_vertices] = normals
+                    if hasattr(data, 'normals_split_custom_set_from_vertices') and \
+                       numpy.array_equal(point_normals[loop_vertices], normals):
+                        data.normals_split_custom_set_from_vertices(point_normals)
+                    else:
+                        data.normals_split_custom_set(normals)
                     if bpy.app.version <= (4, 0):
                         data.use_auto_smooth = True
 
             if self.have_vertex_colors:
-                cols = data.vertex_colors.new()
-                cols.data.foreach_set('color', self.vertex_colors)
+                self.build_vertex_colors(context)
 
-            if data.validate(verbose=True):
+            # Only validate the mesh if build_mesh found anything that isn't
+            # valid, since it is slow.
+            if corrected and data.validate():
                 context.info("Corrected invalid geometry in mesh '{}'.".format(data.name))
 
         if self.dart and not under_dart:
@@ -1610,7 +2687,7 @@ class EggGroup(EggGroupNode):
         if object.name != self.name:
             context.warn("'{}' was renamed to '{}' due to a name conflict".format(self.name, object.name))
 
-        if data and data.name != self.name:
+        if data and data.name != self.name and not self.shared_mesh:
             if data.name != object.name:
                 context.warn("'{}' was renamed to '{}' due to a name conflict".format(self.name, data.name))
 
@@ -1625,58 +2702,44 @@ class EggGroup(EggGroupNode):
             object.dupli_type = 'GROUP'
             object.dupli_group = context.get_external_group(file)
 
-        if not inv_matrix:
-            inv_matrix = context.inv_cs_matrix
-
         if self.matrix:
             # Adjust the matrix to be consistent with the coordinate system.
-            matrix = context.transform_matrix(self.matrix)
-            object.matrix_basis = matrix
-
-            inv_matrix = matmul(matrix.inverted(), inv_matrix)
+            object.matrix_basis = context.transform_matrix(self.matrix)
 
-        if self.is_instance_type():
-            inv_matrix = context.inv_cs_matrix
-
-        # The .egg format specifies vertex data in global space, so we have to
-        # transform the object by its inverse matrix to compensate for that.
-        if inv_matrix and object.type == 'MESH':
-            object.data.transform(inv_matrix)
-
-        # Place it in the scene.  We need to do this before assigning game
-        # properties, below.
+        # Place it in the scene.  In 2.80 and above, this is left to
+        # link_objects, after the whole tree has been built.  Before that, we
+        # need to do this before assigning game properties, below.
         if bpy.app.version >= (2, 80):
-            scene_objects = bpy.context.scene.collection.objects
+            context.new_objects.append((object, True))
         else:
-            scene_objects = bpy.context.scene.objects
-
-        scene_objects.link(object)
+            bpy.context.scene.objects.link(object)
 
         if self.mesh_object and object is not self.mesh_object:
             self.mesh_object.parent = object
-            scene_objects.link(self.mesh_object)
+            if bpy.app.version >= (2, 80):
+                context.new_objects.append((self.mesh_object, False))
+            else:
+                bpy.context.scene.objects.link(self.mesh_object)
 
         # Recurse.
         for child in self.children:
             child.build_tree(context, object, inv_matrix, under_dart or self.dart)
 
-        # Awkward, but it seems there's no other way to set a game property
-        # or create bones or add shape keys.
-        if self.properties or self.dart or self.shape_keys:
-            if bpy.app.version >= (2, 80):
-                active = bpy.context.view_layer.objects.active
-                bpy.context.view_layer.objects.active = object
-            else:
-                active = bpy.context.scene.objects.active
-                bpy.context.scene.objects.active = object
+        if self.shape_keys and self.mesh_object:
+            self.build_shape_keys()
 
-            # Assign properties <Name> { value }
-            # Note: currently most feasible with <ObjectType> attributes
+        # Assign properties <Name> { value }
+        # Note: currently most feasible with <ObjectType> attributes
+        if self.properties:
             if bpy.app.version < (2, 80):
-                # 2.7 and below
+                # 2.7 and below.  Awkward, but it seems there's no other way
+                # to set a game property than on the active object.
+                active = bpy.context.scene.objects.active
+                bpy.context.scene.objects.active = object
                 for name, value in self.properties.items():
                     bpy.ops.object.game_property_new(type='STRING', name=name)
                     object.game.properties[name].value = value
+                bpy.context.scene.objects.active = active
             else:
                 for name, value in self.properties.items():
                     # We can't have multiple properties with the same name "ObjectType"
@@ -1684,47 +2747,20 @@ class EggGroup(EggGroupNode):
                     if name.upper() == "OBJECTTYPE":
                         index = 1
                         for v in value:
-                            bpy.context.object[name + str(index)] = v
+                            object[name + str(index)] = v
                             index += 1
                     else:
-                        bpy.context.object[name] = value
-
-            if self.shape_keys:
-                # Add the basis key first.
-                bpy.ops.object.shape_key_add()
-                basis_data = bpy.context.object.active_shape_key.data
-
-                for key in sorted(self.shape_keys):
-                    bpy.ops.object.shape_key_add()
-                    shape_key = bpy.context.object.active_shape_key
-                    shape_key.name = key
-                    shape_key.slider_min = -10
-                    shape_key.slider_max = 10
-                    data = shape_key.data
-
-                    for vert, index in self.vertices.items():
-                        dxyz = vert.dxyzs.get(key)
-                        if dxyz:
-                            data[index].co = basis_data[index].co + Vector(dxyz)
+                        object[name] = value
 
-            if self.dart and not under_dart:
-                #bpy.context.scene.update()
-                bpy.ops.object.mode_set(mode='EDIT')
-                self.build_armature(context, object, None, Matrix())
-                bpy.ops.object.mode_set(mode='OBJECT')
+        if self.dart and not under_dart:
+            # The bones are created by build_armatures, once the whole tree
+            # has been built, since that requires going into edit mode.
+            context.armatures.append((self, object))
 
-                # If any of the joints below this level define a DefaultPose,
-                # apply this to the pose bones.
-                if self.has_default_pose:
-                    self.apply_default_pose(context, object.pose)
-
-            if bpy.app.version >= (2, 80):
-                bpy.context.view_layer.objects.active = active
-                # Check to see if this node is an empty. If it is, use a 3-axis display for enhanced visibility
-                if object.type == "EMPTY":
-                    object.empty_display_type = self.empty_display_type
-            else:
-                bpy.context.scene.objects.active = active
+        if self.properties or self.dart:
+            # Check to see if this node is an empty. If it is, use a 3-axis display for enhanced visibility
+            if bpy.app.version >= (2, 80) and object.type == "EMPTY":
+                object.empty_display_type = self.empty_display_type
 
             if any(v in self.properties.keys() for v in ('scroll-u', 'scroll-v')):
                 modifier = self.mesh_object.modifiers.new('UVWarp', type='UV_WARP')
@@ -1749,13 +2785,35 @@ class EggGroup(EggGroupNode):
                 add_uv_driver(self.mesh_object, modifier, 0, 'scroll-u')
                 add_uv_driver(self.mesh_object, modifier, 1, 'scroll-v')
 
-        if bpy.app.version >= (2, 80):
-            object.select_set(True)
-        else:
+        if bpy.app.version < (2, 80):
             object.select = True
 
         return object
 
+    def build_shape_keys(self):
+        """ Adds a shape key for each morph target to the mesh object.  Each
+        key is the basis plus the morph offsets of the vertices it affects. """
+
+        object = self.mesh_object
+        num_vertices = len(object.data.vertices)
+
+        # Add the basis key first.
+        basis = object.shape_key_add(name="Basis", from_mix=False)
+        basis_co = numpy.empty(num_vertices * 3, dtype=numpy.float32)
+        basis.data.foreach_get('co', basis_co)
+        basis_co = basis_co.reshape(-1, 3)
+
+        for key, dxyzs in sorted(self.shape_keys.items()):
+            shape_key = object.shape_key_add(name=key, from_mix=False)
+            shape_key.slider_min = -10
+            shape_key.slider_max = 10
+
+            indices = numpy.fromiter(dxyzs.keys(), dtype=numpy.int32, count=len(dxyzs))
+            offsets = numpy.array([dxyz[:3] for dxyz in dxyzs.values()], dtype=numpy.float32).reshape(-1, 3)
+            co = basis_co.copy()
+            co[indices] += offsets
+            shape_key.data.foreach_set('co', co.ravel())
+
     def build_armature(self, context, armature, parent, matrix):
         """ Recursively builds up an armature under a group with dart tag.
         This requires the armature to be active and in edit mode. """
@@ -1774,6 +2832,14 @@ class EggJoint(EggGroup):
         if self.any_geometry_below:
             EggGroup.build_tree(self, context, parent, inv_matrix, under_dart)
 
+    def is_static(self):
+        # Joints are needed to build the armature.
+        return False
+
+    def hash_content(self, content, root=False):
+        # Joints belong to an armature, which can't be instanced.
+        return False
+
     def build_armature(self, context, armature, parent, matrix):
         """ Recursively builds up an armature under a group with dart tag.
         This requires the armature to be active and in edit mode. """
@@ -1880,6 +2946,7 @@ class EggGroupVertexRef:
     def __init__(self, indices):
         self.indices = indices
         self.membership = 1.0
+        self.pool = None
 
     def begin_child(self, context, type, name, values):
         if type.upper() in ('SCALAR', 'CHAR*'):
@@ -1901,6 +2968,9 @@ class EggTable(EggGroupNode):
     def begin_child(self, context, type, name, values):
         type = type.upper()
 
+        if context.is_excluded(type, name):
+            return SKIP
+
         if type == 'TABLE':
             return EggTable(name)
         elif type == 'BUNDLE':
@@ -2127,7 +3197,6 @@ class EggXfmSAnim(EggGroupNode):
                 self.contents = values[0].lower()
 
         elif type == 'V' or type == 'v':
-            values = [parse_number(v) for v in values]
             num_channels = len(self.contents)
             self.num_frames = len(values) // len(self.contents)
             for i, c in enumerate(self.contents):
@@ -2167,4 +3236,4 @@ class EggSAnim(EggNode):
 
     def begin_child(self, context, type, name, values):
         if type.upper() == 'V':
-            self.values += [parse_number(v) for v in values]
+            self.values += values
@@ -0,0 +1,135 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eggparser import EggBufferParser, EggStreamParser, LineIndex, NUMERIC_TYPES
+from eggparser import parse_egg, parse_number, parse_numbers
+
+
+EGG = """<CoordinateSystem> { Z-up } // comment
+<Comment> { "a quoted { string } with <tags>" }
+/* block
+   comment */
+<Texture> "my tex" { "path/with spaces.png" <Scalar> format { rgba } }
+<VertexPool> pool {
+  <Vertex> 0 { 1 -2.5 3e2 <Normal> { 0 0 1 } <RGBA> { 1 0 0 1 } }
+  <Vertex> 1 { nan 1.#INF -1.#inf <UV> uvset { 0x1f 0b101 } }
+  <Vertex> 2 {
+    0.5 0.25 0.125
+    <AUX> data { 1 2 }
+  }
+}
+<Group> a/b {
+  <Tag> t { x "y z" w } /* c */
+  <Polygon> { <V> { 0 1 2 } <VertexRef> { 0 1 2 <Ref> { pool } } }
+}
+<Group>{<Tag>x{1 2}}
+"""
+
+
+def split_parse(doc, cut, skip=()):
+    return list(EggStreamParser([doc[:cut], doc[cut:]]).iterparse(skip))
+
+
+def test_skip_comment_split_across_chunks():
+    for comment in (b'/* } */', b'// }\n'):
+        doc = b'<Table> t { <V> { ' + b'1 ' * 3000 + comment + b' 2 } } <Tag> x { z }'
+        cut = doc.index(comment) + 1
+        assert split_parse(doc, cut, {'TABLE'}) == [
+            ('start', 'Table', 't', []),
+            ('end', 'Table', 't', None),
+            ('start', 'Tag', 'x', ['z']),
+            ('end', 'Tag', 'x', None),
+        ]
+
+
+def test_skip_brace_split_across_chunks():
+    doc = b'<Table> t { <V> { ' + b'1 ' * 3000 + b'{ 2 } } } <Tag> x { z }'
+    cut = doc.index(b'{ 2') + 1
+    assert split_parse(doc, cut, {'TABLE'})[-2:] == [
+        ('start', 'Tag', 'x', ['z']),
+        ('end', 'Tag', 'x', None),
+    ]
+
+
+def test_getvalue():
+    doc = '<Group> g { <Tag> x { y } }'
+    parser = EggBufferParser(doc)
+    assert parser.getvalue() is doc
+    assert list(parser.iterparse())[0] == ('start', 'Group', 'g', [])
+    assert parser.getvalue() is doc
+
+
+class Recorder:
+    """ Visitor that records the begin_child and end_child calls it gets,
+    with the values as strings so that NaNs compare equal. """
+
+    def __init__(self, events=None):
+        self.events = [] if events is None else events
+
+    def begin_child(self, context, type, name, values):
+        self.events.append(('start', type, name, [repr(value) for value in values]))
+        return Recorder(self.events)
+
+    def end_child(self, context, type, name, child):
+        self.events.append(('end', type, name))
+
+
+def record(parse):
+    recorder = Recorder()
+    parse(recorder)
+    return recorder.events
+
+
+def test_buffer_parser_matches_legacy_parser():
+    legacy = record(lambda visitor: parse_egg(io.StringIO(EGG), visitor))
+    assert legacy
+
+    assert record(lambda visitor: EggBufferParser(EGG).parse(visitor)) == legacy
+    assert record(lambda visitor: EggBufferParser(EGG.encode()).parse(visitor)) == legacy
+
+    data = EGG.encode()
+    for size in (1, 2, 3, 7, 64):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        assert record(lambda visitor: EggStreamParser(chunks).parse(visitor)) == legacy
+
+
+def test_numeric_values_match_parse_number():
+    events = record(lambda visitor: parse_egg(io.StringIO(EGG), visitor))
+    types = {event[1].upper() for event in events if event[0] == 'start'}
+    assert {'VERTEX', 'NORMAL', 'UV', 'RGBA', 'V'} <= types
+
+    parser = EggBufferParser(EGG)
+    for event, type, name, values in parser.iterparse():
+        if event == 'start' and type.upper() in NUMERIC_TYPES:
+            assert values.typecode == 'd'
+        elif event == 'start':
+            assert all(isinstance(value, str) for value in values)
+
+    for values in (['1', '-2.5', '3e2'], ['nan', '1.#INF', '-1.#inf'], ['0x1f', '0b101', '2']):
+        expected = [repr(float(parse_number(value))) for value in values]
+        assert [repr(value) for value in parse_numbers(values)] == expected
+        assert [repr(value) for value in parse_numbers([value.encode() for value in values])] == expected
+
+
+def test_line_index_matches_count():
+    for data in (EGG, EGG.encode()):
+        newline = '\n' if isinstance(data, str) else b'\n'
+
+        index = LineIndex()
+        for offset in range(len(data) + 1):
+            index.update(data, offset)
+            assert index.get_lineno(offset) == data[:offset].count(newline) + 1
+
+        # Index a sliding window, as EggStreamParser does.
+        index = LineIndex()
+        base = 0
+        for end in range(8, len(data) + 8, 8):
+            end = min(end, len(data))
+            index.update(data[base:], end, base)
+            for offset in range(base, end + 1):
+                assert index.get_lineno(offset) == data[:offset].count(newline) + 1
+            index.discard(data[base:], end - 4, base)
+            base = end - 4
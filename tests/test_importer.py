@@ -0,0 +1,296 @@
+import importlib.util
+import math
+import os
+import sys
+from array import array
+
+import pytest
+
+bpy = pytest.importorskip("bpy")
+numpy = pytest.importorskip("numpy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_module():
+    spec = importlib.util.spec_from_file_location(
+        "egg_importer", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    module.register()
+
+
+def teardown_module():
+    sys.modules.pop("egg_importer").unregister()
+
+
+def import_egg(tmp_path, text, **options):
+    """ Imports the given .egg text into an empty file, and returns the
+    resulting objects by name. """
+
+    for collection in (bpy.data.objects, bpy.data.meshes, bpy.data.armatures,
+                       bpy.data.materials, bpy.data.collections):
+        for id in list(collection):
+            collection.remove(id)
+
+    path = tmp_path / "test.egg"
+    path.write_text(text)
+    result = bpy.ops.import_scene.egg(directory=str(tmp_path), files=[{'name': path.name}], **options)
+    assert result == {'FINISHED'}
+    return {object.name: object for object in bpy.data.objects}
+
+
+def test_merge_pass_through_group_with_flatten(tmp_path):
+    objects = import_egg(tmp_path, """
+        <VertexPool> p {
+          <Vertex> 0 { 0 0 0 } <Vertex> 1 { 1 0 0 } <Vertex> 2 { 1 1 0 } <Vertex> 3 { 0 1 0 }
+        }
+        <Group> root {
+          <Group> pass {
+            <Group> a { <Polygon> { <VertexRef> { 0 1 2 <Ref> { p } } } }
+            <Group> b { <Polygon> { <VertexRef> { 2 3 0 <Ref> { p } } } }
+          }
+        }
+    """, flatten_groups=True, merge_by_material=True, merge_level=2)
+
+    assert sorted(objects) == ["pass"]
+    assert objects["pass"].type == 'MESH'
+    assert len(objects["pass"].data.polygons) == 2
+    assert len(bpy.data.meshes) == 1
+
+
+def test_share_meshes_keeps_vertex_groups_apart(tmp_path):
+    objects = import_egg(tmp_path, """
+        <VertexPool> p1 { <Vertex> 0 { 0 0 0 } <Vertex> 1 { 1 0 0 } <Vertex> 2 { 1 1 0 } }
+        <VertexPool> p2 { <Vertex> 0 { 0 0 0 } <Vertex> 1 { 1 0 0 } <Vertex> 2 { 1 1 0 } }
+        <Group> g1 { <Polygon> { <VertexRef> { 0 1 2 <Ref> { p1 } } } }
+        <Group> g2 { <Polygon> { <VertexRef> { 0 1 2 <Ref> { p2 } } } }
+        <Group> j1 { <VertexRef> { 0 1 2 <Ref> { p1 } } }
+        <Group> j2 { <VertexRef> { 0 1 <Scalar> membership { 0.5 } <Ref> { p2 } } }
+    """, share_meshes=True)
+
+    assert objects["g1"].data != objects["g2"].data
+    assert [group.name for group in objects["g1"].vertex_groups] == ["j1"]
+    assert [group.name for group in objects["g2"].vertex_groups] == ["j2"]
+    weights = [[group.weight for group in vertex.groups] for vertex in objects["g2"].data.vertices]
+    assert weights == [[0.5], [0.5], []]
+
+
+def test_exclude_groups_keeps_nested_vertex_pools(tmp_path):
+    objects = import_egg(tmp_path, """
+        <Group> hidden {
+          <Group> inner {
+            <VertexPool> p { <Vertex> 0 { 0 0 0 } <Vertex> 1 { 1 0 0 } <Vertex> 2 { 1 1 0 } }
+            <Polygon> { <VertexRef> { 0 1 2 <Ref> { p } } }
+          }
+        }
+        <Group> visible { <Polygon> { <VertexRef> { 0 1 2 <Ref> { p } } } }
+    """, exclude_groups="hidden")
+
+    assert sorted(objects) == ["visible"]
+    assert len(objects["visible"].data.polygons) == 1
+    assert len(bpy.data.meshes) == 1
+
+
+def test_exclude_collide_removes_meshes_below(tmp_path):
+    objects = import_egg(tmp_path, """
+        <VertexPool> p { <Vertex> 0 { 0 0 0 } <Vertex> 1 { 1 0 0 } <Vertex> 2 { 1 1 0 } }
+        <Group> collision {
+          <Group> inner { <Polygon> { <VertexRef> { 0 1 2 <Ref> { p } } } }
+          <Collide> { Polyset keep descend }
+        }
+        <Group> visible { <Polygon> { <VertexRef> { 0 1 2 <Ref> { p } } } }
+    """, exclude_types="Collide")
+
+    assert sorted(objects) == ["visible"]
+    assert len(bpy.data.meshes) == 1
+
+
+def test_validate_non_finite_positions(tmp_path):
+    objects = import_egg(tmp_path, """
+        <VertexPool> p { <Vertex> 0 { 0 0 0 } <Vertex> 1 { nan 0 0 } <Vertex> 2 { 1 1 0 } }
+        <Group> g { <Polygon> { <VertexRef> { 0 1 2 <Ref> { p } } } }
+    """)
+
+    coords = [tuple(vertex.co) for vertex in objects["g"].data.vertices]
+    assert coords[1] == (0.0, 0.0, 0.0)
+
+
+
+def test_build_armatures_restores_selection(tmp_path, monkeypatch):
+    for collection in (bpy.data.objects, bpy.data.armatures):
+        for id in list(collection):
+            collection.remove(id)
+
+    existing = bpy.data.objects.new("existing", bpy.data.armatures.new("existing"))
+    bpy.context.scene.collection.objects.link(existing)
+    view_layer = bpy.context.view_layer
+    existing.select_set(True)
+    view_layer.objects.active = existing
+
+    # Record which objects are in edit mode while the bones are created.
+    importer = sys.modules["egg_importer.importer"]
+    build_armature = importer.EggGroup.build_armature
+    edited = set()
+
+    def record(self, *args, **kwargs):
+        edited.update(object.name for object in view_layer.objects if object.mode == 'EDIT')
+        return build_armature(self, *args, **kwargs)
+
+    monkeypatch.setattr(importer.EggGroup, "build_armature", record)
+
+    path = tmp_path / "test.egg"
+    path.write_text("""
+        <Group> char {
+          <Dart> { 1 }
+          <Joint> root { <Transform> { <Translate> { 0 0 1 } } }
+        }
+    """)
+    result = bpy.ops.import_scene.egg(directory=str(tmp_path), files=[{'name': path.name}])
+    assert result == {'FINISHED'}
+
+    assert edited == {"char"}
+    assert view_layer.objects.active == existing
+    assert existing.select_get()
+    assert bpy.data.objects["char"].select_get()
+    assert len(bpy.data.objects["char"].data.bones) == 1
+
+
+def legacy_strip(indices):
+    """ The triangles of a strip, as the original EggTriangleStrip built them. """
+
+    indices = list(indices)
+    triangles = []
+    prevprev = indices.pop(0)
+    prev = indices.pop(0)
+    flip = False
+    while indices:
+        index = indices.pop(0)
+        if flip:
+            triangles.append([prev, prevprev, index])
+        else:
+            triangles.append([prevprev, prev, index])
+        flip = not flip
+        prevprev = prev
+        prev = index
+    return triangles
+
+
+def legacy_fan(indices):
+    """ The triangles of a fan, as the original EggTriangleFan built them. """
+
+    indices = list(indices)
+    first = indices.pop(0)
+    prev = indices.pop(0)
+    triangles = []
+    while indices:
+        index = indices.pop(0)
+        triangles.append([first, prev, index])
+        prev = index
+    return triangles
+
+
+def test_composite_primitive_expansion():
+    importer = sys.modules["egg_importer.importer"]
+    for count in range(2, 12):
+        indices = array('i', range(10, 10 + count))
+        for cls, legacy in ((importer.EggTriangleStrip, legacy_strip),
+                            (importer.EggTriangleFan, legacy_fan)):
+            triangles = cls.expand(indices)
+            assert [list(triangles[i:i + 3]) for i in range(0, len(triangles), 3)] == legacy(indices)
+
+
+def make_group(faces, states=None):
+    """ Returns a group whose primitive buffer holds the given faces. """
+
+    importer = sys.modules["egg_importer.importer"]
+    group = importer.EggGroup("test", parent=None)
+    for face in faces:
+        group.prim_indices.extend(face)
+        group.prim_offsets.append(len(group.prim_indices))
+    group.prim_states = array('i', states or [0] * len(faces))
+    return group
+
+
+def test_remove_invalid_faces():
+    importer = sys.modules["egg_importer.importer"]
+    faces = [[0, 1, 2], [2, 1, 0], [0, 1], [3, 4, 5, 3], [1, 2, 3, 4], [4, 3, 2, 1],
+             [5, 6, 7], [7, 5, 6], [1, 2, 4, 3], [8, 8, 9], [0, 1, 2]]
+    group = make_group(faces, list(range(len(faces))))
+    group.prim_normals.set(6, (0.0, 1.0, 0.0))
+    group.prim_normals.set(8, (1.0, 0.0, 0.0))
+
+    # What Mesh.validate() removed before: faces with a repeated vertex or
+    # fewer than three, and faces with the same vertices as an earlier one.
+    kept = []
+    seen = set()
+    degenerate = duplicate = 0
+    for index, face in enumerate(faces):
+        if len(face) < 3 or len(set(face)) < len(face):
+            degenerate += 1
+        elif frozenset(face) in seen:
+            duplicate += 1
+        else:
+            seen.add(frozenset(face))
+            kept.append(index)
+
+    context = importer.EggContext()
+    loop_vertices = numpy.frombuffer(group.prim_indices, dtype=numpy.int32) + 100
+    loop_vertices, removed = group.remove_invalid_faces(context, loop_vertices)
+
+    assert removed == degenerate + duplicate
+    assert context.degenerate_faces == degenerate
+    assert context.duplicate_faces == duplicate
+    assert list(group.prim_states) == kept
+    assert list(loop_vertices - 100) == [vertex for index in kept for vertex in faces[index]]
+    assert list(group.prim_indices) == [vertex for index in kept for vertex in faces[index]]
+    offsets = list(group.prim_offsets)
+    assert [offsets[i + 1] - offsets[i] for i in range(len(kept))] == [len(faces[index]) for index in kept]
+    assert [group.prim_normals.get(face) for face in range(len(kept))] == \
+        [(0.0, 1.0, 0.0) if index == 6 else (1.0, 0.0, 0.0) if index == 8 else None for index in kept]
+
+
+def test_weld_vertices():
+    importer = sys.modules["egg_importer.importer"]
+    positions = numpy.array([(0, 0, 0), (1, 0, 0), (0.004, 0, 0), (1, 0, 0), (-0.0, 0, 0),
+                             (2, 2, 2), (1.002, 0.001, 0)], dtype=numpy.float64)
+    loop_vertices = numpy.array([0, 1, 2, 3, 4, 5, 6, 1, 3], dtype=numpy.int32)
+
+    for distance in (0.0, 0.01):
+        # Keep the first vertex in each cell, and map the others onto it.
+        cells = {}
+        remap = []
+        for position in positions.tolist():
+            if distance > 0:
+                cell = tuple(math.floor(c / distance + 0.5) for c in position)
+            else:
+                cell = tuple(c + 0.0 for c in position)
+            remap.append(cells.setdefault(cell, len(cells)))
+        expected = [None] * len(cells)
+        for vertex, cell in enumerate(remap):
+            if expected[cell] is None:
+                expected[cell] = positions[vertex].tolist()
+
+        group = importer.EggGroup("test", parent=None)
+        welded, welded_loops = group.weld_vertices(positions, loop_vertices, distance)
+        assert welded.tolist() == expected
+        assert welded_loops.tolist() == [remap[vertex] for vertex in loop_vertices]
+
+
+def test_vertex_column_take():
+    importer = sys.modules["egg_importer.importer"]
+    column = importer.EggVertexColumn('f', (1.0, 1.0, 1.0, 1.0))
+    column.set(1, (0.5, 0.25, 0.0, 1.0))
+    column.set(4, (0.0, 0.5))
+    indices = numpy.array([0, 1, 2, 4, 4, 5, 100], dtype=numpy.int32)
+
+    values, mask = column.take(indices)
+    for index, value, flag in zip(indices.tolist(), values.tolist(), mask.tolist()):
+        # get() is what the per-loop code used, with the default if unset.
+        expected = column.get(index)
+        assert flag == (expected is not None)
+        assert tuple(value) == (expected or (1.0, 1.0, 1.0, 1.0))
+
+    values, mask = importer.EggVertexColumn('f', (0.0, 0.0)).take(indices)
+    assert not mask.any() and not values.any()